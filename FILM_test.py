@@ -15,7 +15,6 @@ from torch.autograd import Variable
 import torch.backends.cudnn as cudnn
 import torchvision
 from torchvision import transforms
-import torch.nn.functional as F
 import torch.utils.data as data
 from skimage.color import rgb2yuv, yuv2rgb
 
@@ -23,6 +22,8 @@ from utils.util import setup_logger, print_args
 from utils.pytorch_msssim import ssim_matlab
 from models import modules
 from models.modules import define_G
+from models.inference import tiled_forward
+from utils.pipeline import ordered_map, AsyncWriter
 
 def load_networks(network, resume, strict=True):
     load_path = resume
@@ -57,6 +58,11 @@ def main():
 
     ## network setting
     parser.add_argument('--net_name', default='VFIformer', type=str, help='')
+    parser.add_argument('--attn_backend', default='math', type=str, help='math|sdpa, sdpa uses F.scaled_dot_product_attention')
+    parser.add_argument('--refine_levels', default=4, type=int, help='VFIformer only: flow pyramid levels refined, 0-4, fewer is faster')
+    parser.add_argument('--refine_iters', default=0, type=int, help='VFIformer only: refinement iterations per level, 0 for the trained ones')
+    parser.add_argument('--flow_scale', default=0.5, type=float, help='resolution scale of the flow estimation, <1 is faster and steadier on large motions, 0 picks it from the input size')
+    parser.add_argument('--precision', default='fp32', type=str, help='fp32|bf16|fp16, inference precision of convolutions and linear layers')
     parser.add_argument('--window_size', default=8, type=int)
     parser.add_argument('--module_scale_factor', default=2, type=int)
     parser.add_argument('--input_nc', default=3, type=int)
@@ -75,6 +81,8 @@ def main():
     parser.add_argument('--resume_flownet', default='', type=str)
     parser.add_argument('--save_folder', default='./test_results', type=str)
     parser.add_argument('--save_result', action='store_true')
+    parser.add_argument('--tile_size', default=0, type=int, help='run the synthesis in overlapping tiles of this size, 0 to disable')
+    parser.add_argument('--memory_budget', default=0, type=float, help='GB of activation memory per forward pass, picks the tile size')
 
     ## setup training environment
     args = parser.parse_args()
@@ -135,15 +143,38 @@ def main():
 
     logging.info('--- totol images: %d ---' % (len(data_list)))
 
-    PSNR = []
-    SSIM = []
-    down_scale = 0.5
-    for idx in range(len(data_list)):
-        I0, I1, It, folder = data_list[idx]
+    def load_sample(item):
+        # reader threads decode and pad the samples ahead of the network
+        I0, I1, It, folder = item
         img0 = cv2.imread(I0)
         img1 = cv2.imread(I1)
         gt = cv2.imread(It)
 
+        # pad HR to be mutiple of 64
+        h, w, c = gt.shape
+        if h % 64 != 0 or w % 64 != 0:
+            h_new = math.ceil(h / 64) * 64
+            w_new = math.ceil(w / 64) * 64
+            pad_t = 0
+            pad_d = h_new - h
+            pad_l = 0
+            pad_r = w_new - w
+            img0 = cv2.copyMakeBorder(img0.copy(), pad_t, pad_d, pad_l, pad_r, cv2.BORDER_CONSTANT, value=0)  # cv2.BORDER_REFLECT
+            img1 = cv2.copyMakeBorder(img1.copy(), pad_t, pad_d, pad_l, pad_r, cv2.BORDER_CONSTANT, value=0)
+        else:
+            pad_t, pad_d, pad_l, pad_r = 0, 0, 0, 0
+
+        img0 = torch.from_numpy(img0.astype('float32') / 255.).float().permute(2, 0, 1).unsqueeze(0)
+        img1 = torch.from_numpy(img1.astype('float32') / 255.).float().permute(2, 0, 1).unsqueeze(0)
+        gt = torch.from_numpy(gt).permute(2, 0, 1).unsqueeze(0)
+
+        return It, img0, img1, gt, [pad_t, pad_d, pad_l, pad_r]
+
+    PSNR = []
+    SSIM = []
+    writer = AsyncWriter(args.num_workers)
+    for It, img0, img1, gt, pad_nums in ordered_map(load_sample, data_list, args.num_workers):
+
         # # pad HR to be mutiple of 64
         # h, w, c = gt.shape
         # if h % 64 != 0 or w % 64 != 0:
@@ -182,7 +213,7 @@ def main():
 
         #     flow = F.interpolate(flow_down, scale_factor=1/down_scale, mode="bilinear", align_corners=False) * 1/down_scale
 
-        #     output = sliding_forward(net, img0, img1, flow, device)
+        #     output = tiled_forward(net, img0, img1)
 
         # if pad_t != 0 or pad_d != 0 or pad_l != 0 or pad_r != 0:
         #     _, _, h, w = output.size()
@@ -190,46 +221,17 @@ def main():
 
 
 ########################################################
-        # pad HR to be mutiple of 64
-        h, w, c = gt.shape
-        if h % 64 != 0 or w % 64 != 0:
-            h_new = math.ceil(h / 64) * 64
-            w_new = math.ceil(w / 64) * 64
-            pad_t = 0
-            pad_d = h_new - h
-            pad_l = 0
-            pad_r = w_new - w
-            img0 = cv2.copyMakeBorder(img0.copy(), pad_t, pad_d, pad_l, pad_r, cv2.BORDER_CONSTANT, value=0)  # cv2.BORDER_REFLECT
-            img1 = cv2.copyMakeBorder(img1.copy(), pad_t, pad_d, pad_l, pad_r, cv2.BORDER_CONSTANT, value=0)
-        else:
-            pad_t, pad_d, pad_l, pad_r = 0, 0, 0, 0
+        img0, img1, gt = img0.to(device), img1.to(device), gt.to(device)
+        pad_t, pad_d, pad_l, pad_r = pad_nums
 
-        img0 = torch.from_numpy(img0.astype('float32') / 255.).float().permute(2, 0, 1).cuda().unsqueeze(0)
-        img1 = torch.from_numpy(img1.astype('float32') / 255.).float().permute(2, 0, 1).cuda().unsqueeze(0)
-        gt = torch.from_numpy(gt).permute(2, 0, 1).cuda().unsqueeze(0)
-
-        with torch.no_grad():
-            img0_down = F.interpolate(img0, scale_factor=down_scale, mode="bilinear", align_corners=False)
-            img1_down = F.interpolate(img1, scale_factor=down_scale, mode="bilinear", align_corners=False)
-            b, c, h, w = img0_down.size()
-            if h % 64 != 0 or w % 64 != 0:
-                h_new = math.ceil(h / 64) * 64
-                w_new = math.ceil(w / 64) * 64
-                img0_new = torch.zeros((b, c, h_new, w_new)).to(gt.device).float()
-                img1_new = torch.zeros((b, c, h_new, w_new)).to(gt.device).float()
-                img0_new[:, :, :h, :w] = img0_down
-                img1_new[:, :, :h, :w] = img1_down
-                img0_down = img0_new
-                img1_down = img1_new
-
-            flow_down = net.get_flow(img0_down, img1_down)
-            if h % 64 != 0 or w % 64 != 0:
-                flow_down = flow_down[:, :, :h, :w]
-
-            flow = F.interpolate(flow_down, scale_factor=1/down_scale, mode="bilinear", align_corners=False) * 1/down_scale
-
-            # output = sliding_forward(net, img0, img1, flow, device)
-            output, _,  = net(img0, img1, flow_pre=flow)
+        if args.tile_size or args.memory_budget:
+            memory_budget = int(args.memory_budget * 1024 ** 3) if args.memory_budget else None
+            output = tiled_forward(net, img0, img1, tile_size=args.tile_size or None, memory_budget=memory_budget,
+                                   down_scale=args.flow_scale or None)
+        else:
+            with torch.no_grad():
+                # the flow is estimated at args.flow_scale of the input resolution by the network
+                output, _ = net(img0, img1, None)
 
         if pad_t != 0 or pad_d != 0 or pad_l != 0 or pad_r != 0:
             _, _, h, w = output.size()
@@ -251,13 +253,14 @@ def main():
             save_folder = os.path.join(save_folder, basefoler[-3], basefoler[-2])
             if not os.path.exists(save_folder):
                 os.makedirs(save_folder)
-            torchvision.utils.save_image(imt, os.path.join(save_folder, os.path.basename(It)))
+            writer.submit(torchvision.utils.save_image, imt, os.path.join(save_folder, os.path.basename(It)))
 
 
         logging.info('--------- average PSNR: %.06f,  SSIM: %.06f' % (np.mean(PSNR), np.mean(SSIM)))
         # torch.cuda.empty_cache()
 
 
+    writer.close()
     logging.info('***************************************************')
     PSNR = np.mean(PSNR)
     SSIM = np.mean(SSIM)
@@ -266,68 +269,6 @@ def main():
 
 
 
-def sliding_forward(net, img0, img1, flow, device, crop_size=(2000, 2000), stride=(384, 896)): # crop_size=(768, 1280), stride=(384, 896)
-    h, w = img0.size()[2:]
-    if h <= crop_size[0] and w <= crop_size[1]:
-        output, _, _ = net(img0, img1, flow_gt=flow)
-        return output
-
-    else:
-        result = torch.zeros(1, 3, h, w).cuda()
-        count = torch.zeros(1, 1, h, w).cuda()
-        h_steps = 1 + int(math.ceil(float(max(h - crop_size[0], 0)) / stride[0]))
-        w_steps = 1 + int(math.ceil(float(max(w - crop_size[1], 0)) / stride[1]))
-
-        for h_idx in range(h_steps):
-            for w_idx in range(w_steps):
-                ws0, ws1 = w_idx * stride[1], crop_size[1] + w_idx * stride[1]
-                hs0, hs1 = h_idx * stride[0], crop_size[0] + h_idx * stride[0]
-                if h_idx == h_steps - 1:
-                    hs0, hs1 = max(h - crop_size[0], 0), h
-                if w_idx == w_steps - 1:
-                    ws0, ws1 = max(w - crop_size[1], 0), w
-
-                img0_crop = img0[:, :, hs0:hs1, ws0:ws1]
-                img1_crop = img1[:, :, hs0:hs1, ws0:ws1]
-                flow_crop = flow[:, :, hs0:hs1, ws0:ws1]
-
-                output, _, _ = net(img0_crop, img1_crop, flow_gt=flow_crop)
-
-                result[:, :, hs0: hs1, ws0: ws1] += output
-                count[:, :, hs0: hs1, ws0: ws1] += 1
-
-        assert torch.min(count) > 0
-        result = result / count
-        return result
-
-
-
-# def sliding_forward(net, img0, img1, device, crop_size=1280, stride=640): #crop_size=1440, stride=1260
-#     h, w = img0.size()[2:]
-#     if w <= crop_size:
-#         output, flow, merged_img = net(img0, img1, None)
-#         return output
-#     else:
-#         result = torch.zeros(1, 3, h, w).cuda()
-#         count = torch.zeros(1, 1, h, w).cuda()
-#         w_steps = 1 + int(math.ceil(float(max(w - crop_size, 0)) / stride))
-        
-#         for w_idx in range(w_steps):
-#             ws0, ws1 = w_idx * stride, crop_size + w_idx * stride
-#             if w_idx == w_steps - 1:
-#                 ws0, ws1 = max(w - crop_size, 0), w
-
-#             img0_crop = img0[:, :, :, ws0:ws1]
-#             img1_crop = img1[:, :, :, ws0:ws1]
-#             output, flow, merged_img = net(img0_crop, img1_crop, None)
-#             result[:, :, :, ws0: ws1] += output
-#             count[:, :, :, ws0: ws1] += 1
-
-#         assert torch.min(count) > 0
-#         result = result / count
-#         return result
-
-
 if __name__ == '__main__':
     main()
 
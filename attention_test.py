@@ -0,0 +1,74 @@
+import sys
+import torch
+import models.archs.transformer_layers as transformer_layers
+from models.archs.transformer_layers import TFL
+
+# the sdpa attention backend has to match the math one on the same weights, run with
+# `python attention_test.py` (or pytest)
+DIM, NUM_HEADS, WINDOW_SIZE, SHIFT_SIZE = 32, 4, 8, 4
+BATCH, SIZE = 2, (32, 48)
+ATOL, RTOL = 1e-5, 1e-5
+
+
+def build(use_crossattn):
+    torch.manual_seed(0)
+    tfl = TFL(DIM, (WINDOW_SIZE * 2, WINDOW_SIZE * 2), NUM_HEADS, window_size=WINDOW_SIZE,
+              shift_size=SHIFT_SIZE, use_crossattn=use_crossattn).eval()
+    mask_x = tfl.calculate_mask(SIZE)
+    mask_y = tfl.calculate_mask2(SIZE) if use_crossattn else None
+    nW = mask_x.shape[0]
+    x = torch.randn(BATCH * nW, WINDOW_SIZE * WINDOW_SIZE, DIM)
+    y = torch.randn(BATCH * nW, WINDOW_SIZE * WINDOW_SIZE, DIM)
+    return tfl.attn, x, y, mask_x, mask_y
+
+
+def run_backends(attn, run):
+    outputs = {}
+    for backend in transformer_layers.ATTN_BACKENDS:
+        attn.attn_backend = backend
+        with torch.no_grad():
+            outputs[backend] = run()
+    attn.attn_backend = 'math'
+    return outputs
+
+
+def check(outputs, name):
+    diff = (outputs['math'] - outputs['sdpa']).abs().max().item()
+    assert torch.allclose(outputs['math'], outputs['sdpa'], atol=ATOL, rtol=RTOL), \
+        '%s: sdpa differs from math by %g' % (name, diff)
+    print('%s: max diff %g' % (name, diff))
+
+
+def test_window_attention():
+    attn, x, _, mask, _ = build(use_crossattn=False)
+    check(run_backends(attn, lambda: attn(x, mask=None)), 'WindowAttention no mask')
+    check(run_backends(attn, lambda: attn(x, mask=mask)), 'WindowAttention shifted mask')
+
+
+def test_window_cross_attention():
+    attn, x, y, mask_x, mask_y = build(use_crossattn=True)
+    check(run_backends(attn, lambda: attn(x, y, mask_x=None, mask_y=None)), 'WindowCrossAttention no mask')
+    check(run_backends(attn, lambda: attn(x, y, mask_x=mask_x, mask_y=mask_y)), 'WindowCrossAttention shifted mask')
+
+
+def test_chunked_mask():
+    # masks larger than SDPA_MASK_CHUNK_BYTES are attended a few windows at a time
+    chunk_bytes = transformer_layers.SDPA_MASK_CHUNK_BYTES
+    transformer_layers.SDPA_MASK_CHUNK_BYTES = 5 * NUM_HEADS * (WINDOW_SIZE * WINDOW_SIZE) ** 2 * 4
+    try:
+        attn, x, _, mask, _ = build(use_crossattn=False)
+        check(run_backends(attn, lambda: attn(x, mask=mask)), 'WindowAttention chunked mask')
+        attn, x, y, mask_x, mask_y = build(use_crossattn=True)
+        check(run_backends(attn, lambda: attn(x, y, mask_x=mask_x, mask_y=mask_y)), 'WindowCrossAttention chunked mask')
+    finally:
+        transformer_layers.SDPA_MASK_CHUNK_BYTES = chunk_bytes
+
+
+if __name__ == '__main__':
+    try:
+        test_window_attention()
+        test_window_cross_attention()
+        test_chunked_mask()
+    except AssertionError as e:
+        print(e)
+        sys.exit(1)
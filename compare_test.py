@@ -0,0 +1,153 @@
+import os
+import sys
+import time
+import copy
+import logging
+import argparse
+import itertools
+import numpy as np
+import torch
+import torch.backends.cudnn as cudnn
+from utils.util import setup_logger, print_args
+from models.trainer import Trainer
+from models.modules import define_G
+from models.quantize import quantize_G, get_model_size
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Frame Interpolation Regression Check')
+    parser.add_argument('--random_seed', default=0, type=int)
+    parser.add_argument('--name', default='compare_vfiformer', type=str)
+    parser.add_argument('--phase', default='test', type=str)
+
+    ## device setting
+    parser.add_argument('--gpu_ids', type=str, default='0', help='gpu ids: e.g. 0  0,1,2, 0,2. use -1 for CPU')
+    parser.add_argument('--launcher', choices=['none'], default='none',
+                        help='job launcher')
+    parser.add_argument('--local_rank', type=int, default=0)
+
+    ## network setting, the reference always runs in fp32 with the math attention and the full flow refinement
+    parser.add_argument('--net_name', default='VFIformer', type=str, help='')
+    parser.add_argument('--attn_backend', default='math', type=str, help='math|sdpa, sdpa uses F.scaled_dot_product_attention')
+    parser.add_argument('--refine_levels', default=4, type=int, help='VFIformer only: flow pyramid levels refined, 0-4, fewer is faster')
+    parser.add_argument('--refine_iters', default=0, type=int, help='VFIformer only: refinement iterations per level, 0 for the trained ones')
+    parser.add_argument('--flow_scale', default=1, type=float, help='resolution scale of the flow estimation, <1 is faster and steadier on large motions, 0 picks it from the input size')
+    parser.add_argument('--precision', default='fp32', type=str, help='fp32|bf16|fp16, inference precision of convolutions and linear layers')
+    parser.add_argument('--quantize', default='none', type=str, help='none|dynamic|static, int8 linear layers (dynamic) and conv blocks (static), CPU only')
+    parser.add_argument('--calib_samples', default=4, type=int, help='test samples calibrating the static quantization')
+
+    ## dataloader setting
+    parser.add_argument('--data_root', default='/home/sharedir/videos/vimeo_triplet/',type=str)
+    parser.add_argument('--trainset', default='VimeoDataset', type=str, help='VimeoDataset')
+    parser.add_argument('--testset', default='VimeoDataset', type=str, help='VimeoDataset|MiddleburyDataset|UFC101Dataset')
+    parser.add_argument('--crop_size', default=192, type=int)
+    parser.add_argument('--batch_size', default=1, type=int)
+    parser.add_argument('--num_workers', default=4, type=int)
+    parser.add_argument('--data_augmentation', default=False, type=bool)
+    parser.add_argument('--max_samples', default=0, type=int, help='only compare the first N samples, 0 for all')
+    parser.add_argument('--max_psnr_drop', default=0.1, type=float, help='allowed drop of the average PSNR in dB')
+
+    parser.add_argument('--resume', default='./pretrained_models/pretrained_VFIformer/net_220.pth', type=str)
+    parser.add_argument('--resume_flownet', default='', type=str)
+    parser.add_argument('--save_folder', default='./test_results/', type=str)
+
+
+    ## setup testing environment
+    args = parser.parse_args()
+    if args.quantize != 'none':
+        # the int8 kernels only run on CPU
+        args.gpu_ids = '-1'
+
+    ## setup testing device
+    str_ids = args.gpu_ids.split(',')
+    args.gpu_ids = []
+    for str_id in str_ids:
+        id = int(str_id)
+        if id >= 0:
+            args.gpu_ids.append(id)
+    if len(args.gpu_ids) > 0:
+        torch.cuda.set_device(args.gpu_ids[0])
+
+    args.dist = False
+    args.rank = -1
+
+    args.save_folder = os.path.join(args.save_folder, args.name)
+    if not os.path.exists(args.save_folder):
+        os.makedirs(args.save_folder)
+    log_file_path = args.save_folder + '/' + time.strftime('%Y%m%d_%H%M%S') + '.log'
+    setup_logger(log_file_path)
+
+    print_args(args)
+    cudnn.benchmark = True
+
+    ## reference model, the trainer also holds the test dataloader and the metrics
+    ref_args = copy.copy(args)
+    ref_args.precision = 'fp32'
+    ref_args.attn_backend = 'math'
+    ref_args.refine_levels = 4
+    ref_args.refine_iters = 0
+    ref_args.flow_scale = 1.
+    trainer = Trainer(ref_args)
+    args.device = trainer.device
+
+    ## model under test
+    trainer.net_test = define_G(args)
+    trainer.load_networks('net_test', args.resume)
+    trainer.net.eval()
+    trainer.net_test.eval()
+    if args.quantize != 'none':
+        calib_pairs = [(samples['img0'], samples['img1']) for samples in
+                       map(trainer.prepare, itertools.islice(trainer.test_dataloader, args.calib_samples))]
+        trainer.net_test = quantize_G(trainer.net_test, args.quantize, calib_pairs)
+        logging.info('model size: %.2f MB -> %.2f MB' % (get_model_size(trainer.net) / 2**20, get_model_size(trainer.net_test) / 2**20))
+
+    PSNR_ref, PSNR_test, SSIM_ref, SSIM_test, diffs = [], [], [], [], []
+    time_ref, time_test = 0., 0.
+    with torch.no_grad():
+        for batch, batch_samples in enumerate(trainer.test_dataloader):
+            batch_samples = trainer.prepare(batch_samples)
+            img0 = batch_samples['img0']
+            img1 = batch_samples['img1']
+
+            start = time.time()
+            outputs_ref, _ = trainer.net(img0, img1, None)
+            time_ref += time.time() - start
+            start = time.time()
+            outputs_test, _ = trainer.net_test(img0, img1, None)
+            time_test += time.time() - start
+
+            for k in range(outputs_ref.size(0)):
+                gt = batch_samples['gt'][k].unsqueeze(0)
+                folder = batch_samples['folder'][k]
+                pad_t, pad_d, pad_l, pad_r = batch_samples['pad_nums'][k]
+                _, _, h, w = outputs_ref.size()
+                crop = (slice(k, k+1), slice(None), slice(pad_t, h-pad_d), slice(pad_l, w-pad_r))
+
+                psnr_ref, ssim_ref = trainer.calc_metrics(outputs_ref[crop], gt)
+                psnr_test, ssim_test = trainer.calc_metrics(outputs_test[crop].float(), gt)
+                diff = (outputs_ref[crop] - outputs_test[crop].float()).abs().max().item() * 255
+                PSNR_ref.append(psnr_ref)
+                PSNR_test.append(psnr_test)
+                SSIM_ref.append(ssim_ref)
+                SSIM_test.append(ssim_test)
+                diffs.append(diff)
+                logging.info('testing on: %s    psnr: %.6f -> %.6f    ssim: %.6f -> %.6f    max diff: %.2f' %
+                             (folder, psnr_ref, psnr_test, ssim_ref, ssim_test, diff))
+
+            if args.max_samples and len(PSNR_ref) >= args.max_samples:
+                break
+
+    psnr_drop = np.mean(PSNR_ref) - np.mean(PSNR_test)
+    logging.info('--------- reference PSNR: %.06f,  SSIM: %.06f,  time: %.2fs' % (np.mean(PSNR_ref), np.mean(SSIM_ref), time_ref))
+    logging.info('--------- %s/%s/%s/refine%dx%d/flow%g PSNR: %.06f,  SSIM: %.06f,  time: %.2fs' % (args.precision, args.attn_backend,
+                 args.quantize, args.refine_levels, args.refine_iters, args.flow_scale,
+                 np.mean(PSNR_test), np.mean(SSIM_test), time_test))
+    logging.info('--------- PSNR drop: %.06f,  SSIM drop: %.06f,  max pixel diff: %.2f' % (psnr_drop,
+                 np.mean(SSIM_ref) - np.mean(SSIM_test), np.max(diffs)))
+    if psnr_drop > args.max_psnr_drop:
+        logging.info('PSNR drop exceeds %.3f dB' % args.max_psnr_drop)
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,5 +1,6 @@
 # from .dataset import GoProDataset, MixDataset, VideoDataset
-from .data_sampler import DistIterSampler
+from .data_sampler import DistIterSampler, BucketBatchSampler
+from .prefetcher import DevicePrefetcher
 import torch
 import torch.utils.data
 
@@ -14,12 +15,34 @@ def create_dataloader(dataset, args, sampler=None):
             batch_size = args.batch_size // world_size
             shuffle = False
         else:
-            num_workers = args.num_workers * len(args.gpu_ids)
+            num_workers = args.num_workers * max(len(args.gpu_ids), 1)
             batch_size = args.batch_size
-            shuffle = True
+            shuffle = sampler is None
+        # pinned batches let DevicePrefetcher copy them to the gpu asynchronously, the
+        # workers are kept alive between epochs
+        loader_args = {}
+        if num_workers > 0:
+            loader_args = {'persistent_workers': True, 'prefetch_factor': getattr(args, 'prefetch_factor', 2)}
         return torch.utils.data.DataLoader(dataset, batch_size=batch_size, shuffle=shuffle,
                                            num_workers=num_workers, sampler=sampler, drop_last=True,
-                                           pin_memory=False)
+                                           pin_memory=len(args.gpu_ids) > 0, **loader_args)
     else:
-        return torch.utils.data.DataLoader(dataset, batch_size=1, shuffle=False, num_workers=1,
-                                           pin_memory=False)
+        if args.batch_size > 1 and hasattr(dataset, 'get_img_size'):
+            sizes = [dataset.get_img_size(i) for i in range(len(dataset))]
+            batch_sampler = BucketBatchSampler(sizes, args.batch_size)
+        else:
+            batch_sampler = None
+        return torch.utils.data.DataLoader(dataset, batch_size=1, shuffle=False, num_workers=args.num_workers,
+                                           batch_sampler=batch_sampler, collate_fn=bucket_collate, pin_memory=False)
+
+
+def bucket_collate(batch):
+    # inputs of a bucket share their padded size, targets of different sizes are kept as lists
+    sample = {}
+    for key in batch[0].keys():
+        values = [b[key] for b in batch]
+        if torch.is_tensor(values[0]) and all(v.size() == values[0].size() for v in values):
+            sample[key] = torch.stack(values, dim=0)
+        else:
+            sample[key] = values
+    return sample
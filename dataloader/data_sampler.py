@@ -4,6 +4,7 @@ Support enlarging the dataset for *iteration-oriented* training, for saving time
 dataloader after each epoch
 """
 import math
+from collections import OrderedDict
 import torch
 from torch.utils.data.sampler import Sampler
 import torch.distributed as dist
@@ -60,3 +61,31 @@ class DistIterSampler(Sampler):
 
     def set_epoch(self, epoch):
         self.epoch = epoch
+
+
+class BucketBatchSampler(Sampler):
+    """Batch sampler that only puts samples of the same padded size into a batch.
+    It lets the test datasets, whose images may have different resolutions, be
+    evaluated with a batch size larger than one.
+    Arguments:
+        sizes: (h, w) of the images of every sample of the dataset.
+        batch_size: maximum number of samples in a batch.
+        divisor (optional): images are padded to a multiple of it.
+    """
+
+    def __init__(self, sizes, batch_size, divisor=64):
+        buckets = OrderedDict()
+        for idx, (h, w) in enumerate(sizes):
+            key = (math.ceil(h / divisor) * divisor, math.ceil(w / divisor) * divisor)
+            buckets.setdefault(key, []).append(idx)
+
+        self.batches = []
+        for indices in buckets.values():
+            for i in range(0, len(indices), batch_size):
+                self.batches.append(indices[i:i + batch_size])
+
+    def __iter__(self):
+        return iter(self.batches)
+
+    def __len__(self):
+        return len(self.batches)
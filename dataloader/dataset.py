@@ -3,9 +3,9 @@ import numpy as np
 import glob
 import cv2
 import sys
-import random
 import math
 import torch
+from PIL import Image
 from torch.utils.data import Dataset
 
 # sys.path.append('..')
@@ -45,6 +45,11 @@ class VimeoDataset(Dataset):
 
         self.nr_sample = len(self.meta_data)        
 
+    def get_img_size(self, index):
+        # only reads the image header
+        w, h = Image.open(self.meta_data[index][0]).size
+        return h, w
+
     def aug(self, img0, gt, img1, flow_gt, h, w):
         ih, iw, _ = img0.shape
         x = np.random.randint(0, ih - h + 1)
@@ -74,43 +79,12 @@ class VimeoDataset(Dataset):
         img0, gt, img1, flow_gt, folder = self.getimg(index)
         if self.phase == 'train':
             img0, gt, img1, flow_gt = self.aug(img0, gt, img1, flow_gt, self.crop_size, self.crop_size)
-
-            # # attention: can only be used without flow loss !!!
-            # if random.uniform(0, 1) < 0.5:  # rotate
-            #     img0 = np.ascontiguousarray(np.rot90(img0, k=1, axes=(0, 1)))
-            #     img1 = np.ascontiguousarray(np.rot90(img1, k=1, axes=(0, 1)))
-            #     gt = np.ascontiguousarray(np.rot90(gt, k=1, axes=(0, 1)))
-
-            # if random.uniform(0, 1) < 0.5:  # color aug
-            #     img0 = img0[:, :, ::-1]
-            #     img1 = img1[:, :, ::-1]
-            #     gt = gt[:, :, ::-1]
-            if random.uniform(0, 1) < 0.5:  # vertical flip
-                img0 = img0[::-1]
-                img1 = img1[::-1]
-                gt = gt[::-1]
-                flow_gt = flow_gt[::-1]
-                flow_gt = np.concatenate((flow_gt[:, :, 0:1], -flow_gt[:, :, 1:2], flow_gt[:, :, 2:3], -flow_gt[:, :, 3:4]), 2)
-            if random.uniform(0, 1) < 0.5:  # horizontal flip
-                img0 = img0[:, ::-1]
-                img1 = img1[:, ::-1]
-                gt = gt[:, ::-1]
-                flow_gt = flow_gt[:, ::-1]
-                flow_gt = np.concatenate((-flow_gt[:, :, 0:1], flow_gt[:, :, 1:2], -flow_gt[:, :, 2:3], flow_gt[:, :, 3:4]), 2)
-            if random.uniform(0, 1) < 0.5:  # reverse time
-                tmp = img1
-                img1 = img0
-                img0 = tmp
-                flow_gt = np.concatenate((flow_gt[:, :, 2:4], flow_gt[:, :, 0:2]), 2)
-        else:
-            h, w, _ = img0.shape
-            # flow_gt = np.zeros((h, w, 4))
-
-        if self.phase == 'train':
-            flow_gt = torch.from_numpy(flow_gt).float().permute(2, 0, 1)
-            img0 = torch.from_numpy(img0.astype('float32') / 255.).float().permute(2, 0, 1)
-            gt = torch.from_numpy(gt.astype('float32') / 255.).float().permute(2, 0, 1)
-            img1 = torch.from_numpy(img1.astype('float32') / 255.).float().permute(2, 0, 1)
+            # flips, time reversal and the other augmentations run batched on the device,
+            # see Trainer.augment, the frames stay uint8 until then
+            flow_gt = torch.from_numpy(np.ascontiguousarray(flow_gt.transpose(2, 0, 1)))
+            img0 = torch.from_numpy(np.ascontiguousarray(img0.transpose(2, 0, 1)))
+            gt = torch.from_numpy(np.ascontiguousarray(gt.transpose(2, 0, 1)))
+            img1 = torch.from_numpy(np.ascontiguousarray(img1.transpose(2, 0, 1)))
 
             sample = {'img0': img0,
                       'img1': img1,
@@ -132,6 +106,8 @@ class VimeoDataset(Dataset):
             else:
                 pad_t, pad_d, pad_l, pad_r = 0, 0, 0, 0
             pad_nums = [pad_t, pad_d, pad_l, pad_r]
+            # padded like the inputs, so it can be fed to the network as flow_pre
+            flow_gt = np.pad(flow_gt, ((pad_t, pad_d), (pad_l, pad_r), (0, 0)))
 
             flow_gt = torch.from_numpy(flow_gt).float().permute(2, 0, 1)
             img0 = torch.from_numpy(img0.astype('float32') / 255.).float().permute(2, 0, 1)
@@ -149,6 +125,70 @@ class VimeoDataset(Dataset):
         return sample
 
 
+PACKED_ALIGN = 64
+
+
+def get_packed_layout(offset, h, w):
+    # a packed triplet: (3, H, W, 3) uint8 frames, then its (H, W, 4) fp16 flow, both
+    # starting at a multiple of PACKED_ALIGN bytes; returns the flow offset and the end
+    flow_offset = int(math.ceil((offset + 3 * h * w * 3) / PACKED_ALIGN) * PACKED_ALIGN)
+    end = int(math.ceil((flow_offset + h * w * 4 * 2) / PACKED_ALIGN) * PACKED_ALIGN)
+    return flow_offset, end
+
+
+class VimeoPackedDataset(VimeoDataset):
+    """VimeoDataset read from the shards written by pack_vimeo.py.
+
+    The triplets and their flo21/flo23 flows of a phase are stored in large shard files
+    under data_root/packed/<phase>/, index.npz holds the shard and the offsets of every
+    triplet. The shards are memory-mapped, so startup only loads the index and a
+    training sample reads the pages of its crop instead of decoding three PNGs.
+    Training samples are handed out as uint8 frames and fp16 flows.
+    """
+
+    def load_data(self):
+        self.packed_root = os.path.join(self.data_root, 'packed', self.phase)
+        index = np.load(os.path.join(self.packed_root, 'index.npz'))
+        self.folder_data = [str(name) for name in index['names']]
+        self.shard_data = index['shards']
+        self.offset_data = index['offsets']
+        self.size_data = index['sizes']
+        self.meta_data = self.folder_data
+        self.nr_sample = len(self.meta_data)
+        # opened on first use, so every dataloader worker maps the shards itself
+        self.shards = {}
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['shards'] = {}
+        return state
+
+    def get_shard(self, k):
+        if k not in self.shards:
+            path = os.path.join(self.packed_root, 'shard_%03d.bin' % k)
+            self.shards[k] = np.memmap(path, dtype=np.uint8, mode='r')
+        return self.shards[k]
+
+    def get_img_size(self, index):
+        h, w = self.size_data[index]
+        return int(h), int(w)
+
+    def getimg(self, index):
+        shard = self.get_shard(int(self.shard_data[index]))
+        offset = int(self.offset_data[index])
+        h, w = self.get_img_size(index)
+        flow_offset, _ = get_packed_layout(offset, h, w)
+
+        frames = shard[offset:offset + 3 * h * w * 3].reshape(3, h, w, 3)
+        flow_gt = shard[flow_offset:flow_offset + h * w * 4 * 2].view(np.float16).reshape(h, w, 4)
+        img0, gt, img1 = frames[0], frames[1], frames[2]
+        if self.phase != 'train':
+            # whole frames are padded and converted, read them at once
+            img0, gt, img1, flow_gt = np.array(img0), np.array(gt), np.array(img1), np.array(flow_gt)
+
+        return img0, gt, img1, flow_gt, self.folder_data[index]
+
+
 class MiddleburyDataset(Dataset):
     def __init__(self, args):
         self.data_root = args.data_root
@@ -170,6 +210,11 @@ class MiddleburyDataset(Dataset):
 
         self.data_list = data_list
 
+    def get_img_size(self, index):
+        # only reads the image header
+        w, h = Image.open(self.data_list[index][0]).size
+        return h, w
+
     def __getitem__(self, index):
         img0 = cv2.imread(self.data_list[index][0])
         img1 = cv2.imread(self.data_list[index][1])
@@ -225,6 +270,11 @@ class UFC101Dataset(Dataset):
 
         self.data_list = data_list
 
+    def get_img_size(self, index):
+        # only reads the image header
+        w, h = Image.open(self.data_list[index][0]).size
+        return h, w
+
     def __getitem__(self, index):
         img0 = cv2.imread(self.data_list[index][0])
         img1 = cv2.imread(self.data_list[index][1])
@@ -0,0 +1,66 @@
+import time
+import torch
+
+
+def to_device(batch, device, non_blocking=False):
+    # tensors and lists of tensors of a sample dict, names and pad_nums stay on the host
+    out = {}
+    for key, value in batch.items():
+        if torch.is_tensor(value):
+            out[key] = value.to(device, non_blocking=non_blocking)
+        elif isinstance(value, list) and value and torch.is_tensor(value[0]):
+            out[key] = [v.to(device, non_blocking=non_blocking) for v in value]
+        else:
+            out[key] = value
+    return out
+
+
+class DevicePrefetcher(object):
+    """Iterates a DataLoader with the batches already on the device.
+
+    The copy of the next batch is issued before the current one is handed out. On CUDA
+    it runs on a side stream from the pinned batches of the loader, so it overlaps the
+    training step, on other devices the batches are moved synchronously.
+    wait_time is the time the last batch kept the caller waiting on the loader.
+
+    Args:
+        loader (DataLoader): loader of dict samples, with pin_memory on CUDA.
+        device: device the batches are moved to.
+    """
+
+    def __init__(self, loader, device):
+        self.loader = loader
+        self.device = torch.device(device)
+        self.wait_time = 0.
+
+    def __len__(self):
+        return len(self.loader)
+
+    def preload(self, iterator, stream):
+        try:
+            batch = next(iterator)
+        except StopIteration:
+            return None
+        if stream is None:
+            return to_device(batch, self.device)
+        with torch.cuda.stream(stream):
+            return to_device(batch, self.device, non_blocking=True)
+
+    def __iter__(self):
+        stream = torch.cuda.Stream(self.device) if self.device.type == 'cuda' else None
+        iterator = iter(self.loader)
+        start = time.time()
+        batch = self.preload(iterator, stream)
+        while batch is not None:
+            if stream is not None:
+                torch.cuda.current_stream(self.device).wait_stream(stream)
+                # the tensors were allocated on the side stream and are used on the main one
+                for value in batch.values():
+                    for v in (value if isinstance(value, list) else [value]):
+                        if torch.is_tensor(v) and v.is_cuda:
+                            v.record_stream(torch.cuda.current_stream(self.device))
+            next_batch = self.preload(iterator, stream)
+            self.wait_time = time.time() - start
+            yield batch
+            start = time.time()
+            batch = next_batch
@@ -21,8 +21,14 @@ from skimage.color import rgb2yuv, yuv2rgb
 
 from utils.util import setup_logger, print_args
 from utils.pytorch_msssim import ssim_matlab
+from utils.pipeline import ordered_map, AsyncWriter
+from utils.yuv_frame_io import YUVReader, YUVWriter, FRAME_FORMATS
 from models import modules
 from models.modules import define_G
+from models.inference import interpolate_video, batch_interpolate, tiled_forward, pick_tile_settings, get_timesteps, get_bare_model, prepare_frame, \
+    unpad
+from models.export import ExportedModel, ORTModel, export_onnx, get_onnx_path
+from models.flow_cache import FlowCache, CachedFlowModel, load_flow_files
 
 
 
@@ -60,14 +66,36 @@ def main():
 
     ## network setting
     parser.add_argument('--net_name', default='VFIformer', type=str, help='')
+    parser.add_argument('--attn_backend', default='math', type=str, help='math|sdpa, sdpa uses F.scaled_dot_product_attention')
+    parser.add_argument('--refine_levels', default=4, type=int, help='VFIformer only: flow pyramid levels refined, 0-4, fewer is faster')
+    parser.add_argument('--refine_iters', default=0, type=int, help='VFIformer only: refinement iterations per level, 0 for the trained ones')
+    parser.add_argument('--flow_scale', default=1, type=float, help='resolution scale of the flow estimation, <1 is faster and steadier on large motions, 0 picks it from the input size')
+    parser.add_argument('--precision', default='fp32', type=str, help='fp32|bf16|fp16, inference precision of convolutions and linear layers')
 
     ## dataloader setting
     parser.add_argument('--crop_size', default=192, type=int)
     parser.add_argument('--batch_size', default=1, type=int)
-    parser.add_argument('--num_workers', default=4, type=int)
+    parser.add_argument('--num_workers', default=4, type=int, help='reader and writer threads of --video_folder and --pairs_file, 0 runs them inline')
     
-    parser.add_argument('--img0_path', type=str, required=True)
-    parser.add_argument('--img1_path', type=str, required=True)
+    parser.add_argument('--img0_path', type=str, default='')
+    parser.add_argument('--img1_path', type=str, default='')
+    parser.add_argument('--video_folder', type=str, default='', help='folder of frames, interpolates every consecutive pair')
+    parser.add_argument('--raw_video', type=str, default='', help='raw frame stream (e.g. decoder output), interpolated like --video_folder')
+    parser.add_argument('--raw_size', type=str, default='', help='WxH frame size of --raw_video')
+    parser.add_argument('--raw_format', type=str, default='yuv420', help='|'.join(FRAME_FORMATS) + ', pixel format of --raw_video')
+    parser.add_argument('--yuv_matrix', type=str, default='bt601', help='bt601|bt709, YCbCr matrix of --raw_video')
+    parser.add_argument('--yuv_full_range', action='store_true', help='--raw_video uses full range (0-255) YCbCr levels')
+    parser.add_argument('--raw_output', type=str, default='', help='video modes: write the input and inserted frames in display order to this raw stream (file or fifo) instead of pngs')
+    parser.add_argument('--raw_output_format', type=str, default='', help='|'.join(FRAME_FORMATS) + ', pixel format of --raw_output, default: --raw_format')
+    parser.add_argument('--pairs_file', type=str, default='', help='text file with one "img0_path img1_path" pair per line, run in batches of --batch_size')
+    parser.add_argument('--tile_size', default=0, type=int, help='run the synthesis in overlapping tiles of this size, 0 to disable')
+    parser.add_argument('--memory_budget', default=0, type=float, help='GB of activation memory per forward pass, picks the tile size')
+    parser.add_argument('--multi', default=2, type=int, help='frame rate multiplier: 2|4|8, inserts multi-1 frames per pair')
+    parser.add_argument('--export', default='none', type=str, help='none|trace|compile, run pairs through a traced or compiled model, exported next to --resume')
+    parser.add_argument('--backend', default='pytorch', type=str, help='pytorch|onnxruntime, onnxruntime runs pairs through the onnx model next to --resume, exported on first use')
+    parser.add_argument('--ort_threads', default=0, type=int, help='intra-op threads of onnxruntime, 0 for its default')
+    parser.add_argument('--flow_cache', default='', type=str, help='folder of cached flows, re-runs of the same frames skip the flow estimation')
+    parser.add_argument('--flow_files', default='', type=str, help='single pair only: comma separated flow of the pair, one 4 channel .npy or the flows towards img0 and img1 (.npy|.flo, e.g. flo21.npy,flo23.npy of compute_flow_vimeo.py)')
 
     parser.add_argument('--resume', default='./pretrained_models/pretrained_VFIformer/net_220.pth', type=str)
     parser.add_argument('--resume_flownet', default='', type=str)
@@ -75,6 +103,14 @@ def main():
 
     ## setup training environment
     args = parser.parse_args()
+    if not args.video_folder and not args.raw_video and not args.pairs_file and not (args.img0_path and args.img1_path):
+        parser.error('either --video_folder, --raw_video, --pairs_file or both --img0_path and --img1_path are required')
+    if args.multi < 2:
+        parser.error('--multi must be at least 2, got %d' % args.multi)
+    if args.raw_video and not args.raw_size:
+        parser.error('--raw_video needs --raw_size')
+    if (args.flow_cache or args.flow_files) and (args.backend != 'pytorch' or args.export != 'none'):
+        parser.error('--flow_cache and --flow_files need the eager pytorch model')
 
     ## setup training device
     str_ids = args.gpu_ids.split(',')
@@ -111,12 +147,92 @@ def main():
     net = define_G(args)
     net = load_networks(net, args.resume)
     net.eval()
+    # precomputed flows skip the IFNet and the flow refinement
+    flow_cache = None
+    if args.flow_cache:
+        flow_cache = FlowCache(args.flow_cache, net)
+        net = CachedFlowModel(net, flow_cache)
+    # exported models only cover the plain pair forward, video, tiles and --multi run eagerly
+    if args.backend == 'onnxruntime':
+        onnx_path = get_onnx_path(args)
+        if not os.path.exists(onnx_path):
+            export_onnx(net, onnx_path, device)
+        pair_net = ORTModel(onnx_path, args.ort_threads)
+    elif args.export != 'none':
+        pair_net = ExportedModel(net, args, args.export)
+    else:
+        pair_net = net
 
     ## load data
-
+    # reader threads decode and pad the frames, writer threads encode the results, the
+    # network runs in between without waiting for either
+    if args.video_folder or args.raw_video:
+        if args.raw_video:
+            # frames are converted straight from the memory mapped stream, no intermediate images
+            w, h = [int(x) for x in args.raw_size.split('x')]
+            reader = YUVReader(args.raw_video, h, w, args.raw_format, args.yuv_matrix, args.yuv_full_range)
+            names = ['%06d' % idx for idx in range(len(reader))]
+            frames = ordered_map(lambda idx: prepare_frame(reader[idx]), range(len(reader)), args.num_workers)
+        else:
+            frame_paths = sorted(glob.glob(os.path.join(args.video_folder, '*.png')) + glob.glob(os.path.join(args.video_folder, '*.jpg')))
+            names = [os.path.basename(path).split('.')[0] for path in frame_paths]
+            frames = ordered_map(lambda path: prepare_frame(cv2.imread(path)), frame_paths, args.num_workers)
+        if args.raw_output:
+            # the stream gets every input frame followed by the frames inserted after it
+            h, w = (reader.h, reader.w) if args.raw_video else cv2.imread(frame_paths[0]).shape[:2]
+            out_format = args.raw_output_format or args.raw_format
+            raw_writer = YUVWriter(args.raw_output, h, w, out_format, args.yuv_matrix, args.yuv_full_range,
+                                   pin_memory=device.type == 'cuda')
+
+            # input frames are written from their decoded tensors, the conversion of every frame runs
+            # on the writer threads and the stream gets the converted frames in submission order
+            passthrough = args.raw_video and out_format == args.raw_format
+            decoded = {}
+
+            def keep_frames(frames):
+                for idx, frame in enumerate(frames):
+                    if not passthrough:
+                        decoded[idx] = frame
+                    yield frame
+
+            with AsyncWriter(args.num_workers, sink=raw_writer.write_packed) as writer:
+                def write_input(idx):
+                    if passthrough:
+                        writer.submit(raw_writer.pack_raw, reader.raw(idx))
+                    else:
+                        frame, pad_nums = decoded.pop(idx)
+                        writer.submit(raw_writer.pack, unpad(frame, pad_nums))
+
+                for idx, outputs in interpolate_video(net, keep_frames(frames), device, multi=args.multi):
+                    write_input(idx)
+                    writer.submit(raw_writer.pack, torch.cat(outputs, 0))
+                if names:
+                    write_input(len(names) - 1)
+            raw_writer.close()
+            print_cache_stats(flow_cache)
+            print('%d frames written to %s' % (raw_writer.num_frames, args.raw_output))
+            return
+
+        with AsyncWriter(args.num_workers) as writer:
+            for idx, outputs in interpolate_video(net, frames, device, multi=args.multi):
+                writer.submit(save_outputs, outputs, save_path, names[idx])
+        print_cache_stats(flow_cache)
+        print('%d results saved!' % max(len(names) - 1, 0))
+        return
+
+    if args.pairs_file:
+        with open(args.pairs_file, 'r') as txt:
+            pair_paths = [line.split() for line in txt if line.strip()]
+        pairs = ordered_map(lambda paths: (cv2.imread(paths[0]), cv2.imread(paths[1])), pair_paths, args.num_workers)
+        with AsyncWriter(args.num_workers) as writer:
+            for idx, output in batch_interpolate(pair_net, pairs, device, batch_size=args.batch_size):
+                writer.submit(save_outputs, [output], save_path, os.path.basename(pair_paths[idx][0]).split('.')[0])
+        print_cache_stats(flow_cache)
+        print('%d results saved!' % len(pair_paths))
+        return
 
     divisor = 64
-    multi = 3
+    multi = args.multi
 
     img0 = cv2.imread(args.img0_path)
     img1 = cv2.imread(args.img1_path)
@@ -134,19 +250,50 @@ def main():
     else:
         pad_t, pad_d, pad_l, pad_r = 0, 0, 0, 0
 
-    img0 = torch.from_numpy(img0.astype('float32') / 255.).float().permute(2, 0, 1).cuda().unsqueeze(0)
-    img1 = torch.from_numpy(img1.astype('float32') / 255.).float().permute(2, 0, 1).cuda().unsqueeze(0)
+    img0 = torch.from_numpy(img0.astype('float32') / 255.).float().permute(2, 0, 1).to(device).unsqueeze(0)
+    img1 = torch.from_numpy(img1.astype('float32') / 255.).float().permute(2, 0, 1).to(device).unsqueeze(0)
 
     with torch.no_grad():
-        output, _ = net(img0, img1, None)
-        h, w = output.size()[2:]
-        output = output[:, :, pad_t:h-pad_d, pad_l:w-pad_r]
+        tiled = args.tile_size or args.memory_budget
+        if tiled:
+            memory_budget = int(args.memory_budget * 1024 ** 3) if args.memory_budget else None
+            tile_size, down_scale = pick_tile_settings(img0.size(2), img0.size(3), args.tile_size or None, memory_budget)
+
+        flow_pre = None
+        if args.flow_files:
+            flow_pre = load_flow_files(args.flow_files.split(','), device, [pad_t, pad_d, pad_l, pad_r])
+        elif flow_cache is not None:
+            # tiles take the flow estimated at their downscaled resolution, not the full one
+            flow_pre = flow_cache.get_flow(img0, img1, flow_scale=down_scale if tiled else None)
+
+        if tiled:
+            outputs = [tiled_forward(net, img0, img1, tile_size=tile_size, memory_budget=memory_budget,
+                                     down_scale=down_scale, flow=flow_pre)]
+        elif multi == 2:
+            output, _ = pair_net(img0, img1, flow_pre)
+            outputs = [output]
+        else:
+            outputs = get_bare_model(net).forward_multi(img0, img1, get_timesteps(multi), flow_pre=flow_pre)
+        h, w = outputs[0].size()[2:]
+        outputs = [output[:, :, pad_t:h-pad_d, pad_l:w-pad_r] for output in outputs]
 
-    imt = output[0].flip(dims=(0,)).clamp(0., 1.)
-    torchvision.utils.save_image(imt, os.path.join(save_path, os.path.basename(args.img0_path).split('.')[0]+'_inter'+'.png'))
+    save_outputs(outputs, save_path, os.path.basename(args.img0_path).split('.')[0])
+    print_cache_stats(flow_cache)
     print('result saved!')
 
 
+def print_cache_stats(flow_cache):
+    if flow_cache is not None:
+        print('flow cache: %d hits, %d misses' % (flow_cache.hits, flow_cache.misses))
+
+
+def save_outputs(outputs, save_path, name):
+    for i, output in enumerate(outputs):
+        imt = output[0].flip(dims=(0,)).clamp(0., 1.)
+        suffix = '_inter' if len(outputs) == 1 else '_inter%d' % (i + 1)
+        torchvision.utils.save_image(imt, os.path.join(save_path, name+suffix+'.png'))
+
+
 
 if __name__ == '__main__':
     main()
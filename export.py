@@ -0,0 +1,116 @@
+import time
+import logging
+import math
+import argparse
+from collections import OrderedDict
+import torch
+import torch.nn as nn
+from torch.nn.parallel import DistributedDataParallel
+
+from utils.util import print_args
+from models.modules import define_G
+from models.export import ExportedModel, EXPORT_MODES, ORTModel, export_onnx, get_onnx_path
+
+
+
+def load_networks(network, resume):
+    if isinstance(network, nn.DataParallel) or isinstance(network, DistributedDataParallel):
+        network = network.module
+    load_net = torch.load(resume, map_location=torch.device('cpu'))
+    load_net_clean = OrderedDict()  # remove unnecessary 'module.'
+    for k, v in load_net.items():
+        if k.startswith('module.'):
+            load_net_clean[k[7:]] = v
+        else:
+            load_net_clean[k] = v
+    network.load_state_dict(load_net_clean)
+
+    return network
+
+
+def main():
+    parser = argparse.ArgumentParser(description='export traced, compiled or onnx inference models')
+    parser.add_argument('--phase', default='test', type=str)
+
+    ## device setting
+    parser.add_argument('--gpu_ids', type=str, default='0', help='gpu ids: e.g. 0  0,1,2, 0,2. use -1 for CPU')
+
+    ## network setting
+    parser.add_argument('--net_name', default='VFIformer', type=str, help='')
+    parser.add_argument('--attn_backend', default='math', type=str, help='math|sdpa, sdpa uses F.scaled_dot_product_attention')
+    parser.add_argument('--refine_levels', default=4, type=int, help='VFIformer only: flow pyramid levels refined, 0-4, fewer is faster')
+    parser.add_argument('--refine_iters', default=0, type=int, help='VFIformer only: refinement iterations per level, 0 for the trained ones')
+    parser.add_argument('--flow_scale', default=1, type=float, help='resolution scale of the flow estimation, <1 is faster and steadier on large motions, 0 picks it from the input size')
+    parser.add_argument('--precision', default='fp32', type=str, help='fp32|bf16|fp16, inference precision of convolutions and linear layers')
+    parser.add_argument('--crop_size', default=192, type=int)
+
+    ## export setting
+    parser.add_argument('--mode', default='trace', type=str, help='|'.join(EXPORT_MODES + ('onnx',)))
+    parser.add_argument('--sizes', default='256x448', type=str, help='comma separated HxW input sizes, padded to multiples of 64')
+    parser.add_argument('--batch_size', default=1, type=int)
+    parser.add_argument('--benchmark', default=3, type=int, help='timed runs of the eager and the exported model per size, 0 to skip')
+    parser.add_argument('--ort_threads', default=0, type=int, help='intra-op threads of onnxruntime, 0 for its default')
+    parser.add_argument('--tolerance', default=1e-3, type=float, help='largest allowed difference between the exported and the eager output')
+
+    parser.add_argument('--resume', default='./pretrained_models/pretrained_VFIformer/net_220.pth', type=str)
+    parser.add_argument('--resume_flownet', default='', type=str)
+
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s [%(levelname)s] %(message)s')
+
+    ## setup device
+    args.gpu_ids = [int(str_id) for str_id in args.gpu_ids.split(',') if int(str_id) >= 0]
+    if len(args.gpu_ids) > 0:
+        torch.cuda.set_device(args.gpu_ids[0])
+    args.dist = False
+    device = torch.device('cuda' if len(args.gpu_ids) != 0 else 'cpu')
+    args.device = device
+    print_args(args)
+
+    ## load model
+    net = define_G(args)
+    net = load_networks(net, args.resume)
+    net.eval()
+    if args.mode == 'onnx':
+        path = get_onnx_path(args)
+        export_onnx(net, path, device)
+        exported = ORTModel(path, args.ort_threads)
+    else:
+        exported = ExportedModel(net, args, args.mode)
+
+    ## export (or warm up the compile cache for) every size
+    divisor = 64
+    for size in args.sizes.split(','):
+        h, w = [int(x) for x in size.split('x')]
+        h = math.ceil(h / divisor) * divisor
+        w = math.ceil(w / divisor) * divisor
+        img0 = torch.rand((args.batch_size, 3, h, w), device=device)
+        img1 = torch.rand((args.batch_size, 3, h, w), device=device)
+
+        start = time.time()
+        output, _ = exported(img0, img1)
+        logging.info('%dx%dx%d built in %.2fs' % (args.batch_size, h, w, time.time() - start))
+
+        # parity with the eager model
+        with torch.no_grad():
+            output_ref, _ = net(img0, img1, None)
+        diff = (output.float() - output_ref.float()).abs().max().item()
+        logging.info('%dx%dx%d max difference to the eager model: %.6f' % (args.batch_size, h, w, diff))
+        if diff > args.tolerance:
+            raise RuntimeError('%s output differs from the eager model by %.6f at %dx%d' % (args.mode, diff, h, w))
+
+        if args.benchmark:
+            with torch.no_grad():
+                start = time.time()
+                for _ in range(args.benchmark):
+                    net(img0, img1, None)
+                eager = (time.time() - start) / args.benchmark
+            start = time.time()
+            for _ in range(args.benchmark):
+                exported(img0, img1)
+            export = (time.time() - start) / args.benchmark
+            logging.info('%dx%dx%d eager: %.4fs  %s: %.4fs' % (args.batch_size, h, w, eager, args.mode, export))
+
+
+if __name__ == '__main__':
+    main()
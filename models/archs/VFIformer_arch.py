@@ -6,6 +6,7 @@ from torch.nn import init
 import torch.nn.functional as F
 from torch.nn.parallel import DistributedDataParallel
 import functools
+import contextlib
 import copy
 from functools import partial, reduce
 import numpy as np
@@ -18,6 +19,67 @@ from models.archs.warplayer import warp
 from models.archs.transformer_layers import TFModel
 
 
+# inference precisions: convolutions and linear layers run in the reduced precision under
+# autocast, while warp, the flow accumulation of IFNet and the attention softmax stay in fp32
+PRECISIONS = {'fp32': torch.float32, 'bf16': torch.bfloat16, 'fp16': torch.float16}
+
+
+# pyramid levels of FlowRefineNet_Multis, VFIformer can refine fewer of them for a lower latency
+REFINE_LEVELS = 4
+
+
+def autocast(x, precision):
+    # fp32 runs without entering autocast at all, it needs no autocast support of the torch release
+    if precision == 'fp32':
+        return contextlib.nullcontext()
+    return torch.autocast(device_type=x.device.type, dtype=PRECISIONS[precision])
+
+
+def make_grad_scaler(precision, device):
+    # fp16 gradients are scaled against underflow, bf16 has the range of fp32 and needs none
+    if precision != 'fp16':
+        return None
+    if hasattr(torch.amp, 'GradScaler'):
+        return torch.amp.GradScaler(device.type)
+    return torch.cuda.amp.GradScaler()
+
+
+# the flow of large inputs is estimated on downscaled frames, flow_scale 0 picks the largest
+# of 1, 1/2, 1/4, ... that brings the frames down to FLOW_MAX_PIXELS
+FLOW_MAX_PIXELS = 1280 * 720
+
+
+def pick_flow_scale(flow_scale, h, w):
+    if flow_scale:
+        return flow_scale
+    flow_scale = 1.
+    while flow_scale > 1 / 16 and h * w * flow_scale ** 2 > FLOW_MAX_PIXELS:
+        flow_scale /= 2
+    return flow_scale
+
+
+def get_flow_scaled(net, img0, img1, flow_scale, divisor=64):
+    # estimate the flow on downscaled inputs and upsample it to the input resolution
+    if flow_scale == 1:
+        return net.get_flow(img0, img1)
+
+    img0_down = F.interpolate(img0, scale_factor=flow_scale, mode="bilinear", align_corners=False)
+    img1_down = F.interpolate(img1, scale_factor=flow_scale, mode="bilinear", align_corners=False)
+    b, c, h, w = img0_down.size()
+    h_new = math.ceil(h / divisor) * divisor
+    w_new = math.ceil(w / divisor) * divisor
+    if h_new != h or w_new != w:
+        img0_down = F.pad(img0_down, (0, w_new - w, 0, h_new - h))
+        img1_down = F.pad(img1_down, (0, w_new - w, 0, h_new - h))
+
+    flow_down = net.get_flow(img0_down, img1_down)[:, :, :h, :w]
+    H, W = img0.size()[2:]
+    flow = F.interpolate(flow_down, size=(H, W), mode="bilinear", align_corners=False)
+    scale = torch.tensor([W / w, H / h, W / w, H / h], device=flow.device).view(1, 4, 1, 1)
+
+    return flow * scale
+
+
 def make_layer(block, n_layers):
     layers = []
     for _ in range(n_layers):
@@ -117,17 +179,18 @@ class IFNet(nn.Module):
         self.block2 = IFBlock(10, scale=1, c=90)
 
     def forward(self, x):
-        flow0 = self.block0(x)
+        # flows are accumulated in fp32, the blocks may run in reduced precision
+        flow0 = self.block0(x).float()
         F1 = flow0
         F1_large = F.interpolate(F1, scale_factor=2.0, mode="bilinear", align_corners=False) * 2.0
         warped_img0 = warp(x[:, :3], F1_large[:, :2])
         warped_img1 = warp(x[:, 3:], F1_large[:, 2:4])
-        flow1 = self.block1(torch.cat((warped_img0, warped_img1, F1_large), 1))
+        flow1 = self.block1(torch.cat((warped_img0, warped_img1, F1_large), 1)).float()
         F2 = (flow0 + flow1)
         F2_large = F.interpolate(F2, scale_factor=2.0, mode="bilinear", align_corners=False) * 2.0
         warped_img0 = warp(x[:, :3], F2_large[:, :2])
         warped_img1 = warp(x[:, 3:], F2_large[:, 2:4])
-        flow2 = self.block2(torch.cat((warped_img0, warped_img1, F2_large), 1))
+        flow2 = self.block2(torch.cat((warped_img0, warped_img1, F2_large), 1)).float()
         F3 = (flow0 + flow1 + flow2)
 
         return F3, [F1, F2, F3]
@@ -181,40 +244,53 @@ class FlowRefineNetA(nn.Module):
         norm = norm ** (0.5)
         return (x/norm)
 
+    def local_corr(self, fea, x, flow):
+        """Correlation of fea with the (2r+1)^2 neighbourhood of x warped by flow.
+
+        Gives the same values as correlating fea with warp(F.unfold(x), flow), but samples
+        the C channel x once per neighbour instead of warping a C*n_pts channel tensor:
+        warp clamps the sampling position to the image, the unfolded neighbours of the
+        clamped position are read from x zero padded by r.
+
+        Args:
+            fea (Tensor): (B, C, H, W) L2 normalized over C.
+            x (Tensor): (B, C, H, W) features to warp.
+            flow (Tensor): (B, 2, H, W)
+
+        Returns:
+            Tensor: (B, n_pts, H, W) in F.unfold order.
+        """
+        B, C, H, W = x.size()
+        r = self.r
+        with torch.autocast(device_type=x.device.type, enabled=False):
+            fea, x, flow = fea.float(), x.float(), flow.float()
+            grid_x = (torch.arange(W, device=x.device, dtype=x.dtype).view(1, 1, W) + flow[:, 0]).clamp(0, W - 1) + r
+            grid_y = (torch.arange(H, device=x.device, dtype=x.dtype).view(1, H, 1) + flow[:, 1]).clamp(0, H - 1) + r
+            x = F.pad(x, (r, r, r, r))
+            corrs = []
+            for dy in range(-r, r + 1):
+                for dx in range(-r, r + 1):
+                    grid = torch.stack([(grid_x + dx) * (2.0 / (W + 2 * r - 1)) - 1.0,
+                                        (grid_y + dy) * (2.0 / (H + 2 * r - 1)) - 1.0], dim=-1)
+                    content = F.grid_sample(x, grid, mode='bilinear', padding_mode='zeros', align_corners=True)
+                    corrs.append((fea * self.L2normalize(content)).sum(dim=1, keepdim=True))
+
+        return torch.cat(corrs, dim=1)
+
     def forward_once(self, x0, x1, flow0, flow1):
         B, C, H, W = x0.size()
 
-        x0_unfold = F.unfold(x0, kernel_size=(self.r * 2 + 1), padding=1).view(B, C * self.n_pts, H,
-                                                                               W)  # (B, C*n_pts, H, W)
-        x1_unfold = F.unfold(x1, kernel_size=(self.r * 2 + 1), padding=1).view(B, C * self.n_pts, H,
-                                                                               W)  # (B, C*n_pts, H, W)
-        contents0 = warp(x0_unfold, flow0)
-        contents1 = warp(x1_unfold, flow1)
-
-        contents0 = contents0.view(B, C, self.n_pts, H, W)
-        contents1 = contents1.view(B, C, self.n_pts, H, W)
-
-        fea0 = contents0[:, :, self.n_pts // 2, :, :]
-        fea1 = contents1[:, :, self.n_pts // 2, :, :]
+        fea0 = warp(x0, flow0)
+        fea1 = warp(x1, flow1)
 
         # get context feature
         occl = self.occl_convs(torch.cat([fea0, fea1], dim=1))
         fea = fea0 * occl + fea1 * (1 - occl)
 
         # get correlation features
-        fea_view = fea.permute(0, 2, 3, 1).contiguous().view(B * H * W, 1, C)
-        contents0 = contents0.permute(0, 3, 4, 2, 1).contiguous().view(B * H * W, self.n_pts, C)
-        contents1 = contents1.permute(0, 3, 4, 2, 1).contiguous().view(B * H * W, self.n_pts, C)
-
-        fea_view = self.L2normalize(fea_view, dim=-1)
-        contents0 = self.L2normalize(contents0, dim=-1)
-        contents1 = self.L2normalize(contents1, dim=-1)
-        corr0 = torch.einsum('bic,bjc->bij', fea_view, contents0)  # (B*H*W, 1, n_pts)
-        corr1 = torch.einsum('bic,bjc->bij', fea_view, contents1)
-        # corr0 = corr0 / torch.sqrt(torch.tensor(C).float())
-        # corr1 = corr1 / torch.sqrt(torch.tensor(C).float())
-        corr0 = corr0.view(B, H, W, self.n_pts).permute(0, 3, 1, 2).contiguous()  # (B, n_pts, H, W)
-        corr1 = corr1.view(B, H, W, self.n_pts).permute(0, 3, 1, 2).contiguous()
+        fea_norm = self.L2normalize(fea.float())
+        corr0 = self.local_corr(fea_norm, x0, flow0)  # (B, n_pts, H, W)
+        corr1 = self.local_corr(fea_norm, x1, flow1)
         corr0 = self.corr_convs(corr0)  # (B, corr_dim, H, W)
         corr1 = self.corr_convs(corr1)
 
@@ -236,8 +312,8 @@ class FlowRefineNetA(nn.Module):
 
         return flow0, flow1
 
-    def forward(self, x0, x1, flow0, flow1):
-        for i in range(self.n_iters):
+    def forward(self, x0, x1, flow0, flow1, n_iters=None):
+        for i in range(n_iters or self.n_iters):
             flow0, flow1 = self.forward_once(x0, x1, flow0, flow1)
 
         return torch.cat([flow0, flow1], dim=1)
@@ -257,57 +333,98 @@ class FlowRefineNet_Multis(nn.Module):
         self.rf_block3 = FlowRefineNetA(context_dim=4 * c, c=4 * c, r=1, n_iters=n_iters)
         self.rf_block4 = FlowRefineNetA(context_dim=8 * c, c=8 * c, r=1, n_iters=n_iters)
 
-    def get_context(self, x0, x1, flow):
-        bs = x0.size(0)
+        # only the refine_levels finest pyramid levels are refined, see set_refine
+        self.refine_levels = REFINE_LEVELS
+        self.refine_iters = None
 
-        inp = torch.cat([x0, x1], dim=0)
-        s_1 = self.conv1(inp)  # 1
+    def get_features(self, x):
+        s_1 = self.conv1(x)  # 1
         s_2 = self.conv2(s_1)  # 1/2
         s_3 = self.conv3(s_2)  # 1/4
         s_4 = self.conv4(s_3)  # 1/8
 
+        return [s_1, s_2, s_3, s_4]
+
+    def get_pair_features(self, x0, x1, feas0=None, feas1=None):
+        # features of a frame only depend on the frame itself, so callers streaming
+        # consecutive pairs can pass the ones they already computed
+        if feas0 is None and feas1 is None:
+            bs = x0.size(0)
+            feas = self.get_features(torch.cat([x0, x1], dim=0))
+            return [s[:bs] for s in feas], [s[bs:] for s in feas]
+        if feas0 is None:
+            feas0 = self.get_features(x0)
+        if feas1 is None:
+            feas1 = self.get_features(x1)
+
+        return feas0, feas1
+
+    def get_stacked_features(self, x0, x1, feas0=None, feas1=None):
+        # pyramids of x0 and x1 stacked along the batch, the layout warp_fea works on
+        if feas0 is None and feas1 is None:
+            return self.get_features(torch.cat([x0, x1], dim=0))
+        feas0, feas1 = self.get_pair_features(x0, x1, feas0, feas1)
+        return [torch.cat([s0, s1], dim=0) for s0, s1 in zip(feas0, feas1)]
+
+    def get_context(self, x0, x1, flow, feas0=None, feas1=None):
+        feas = self.get_stacked_features(x0, x1, feas0, feas1)
+
         # warp features by the updated flow
-        c0 = [s_1[:bs], s_2[:bs], s_3[:bs], s_4[:bs]]
-        c1 = [s_1[bs:], s_2[bs:], s_3[bs:], s_4[bs:]]
-        out0 = self.warp_fea(c0, flow[:, :2])
-        out1 = self.warp_fea(c1, flow[:, 2:4])
+        out0, out1 = self.warp_fea(feas, flow)
 
         return flow, out0, out1
 
-    def forward(self, x0, x1, flow):
-        bs = x0.size(0)
+    def set_refine(self, levels=REFINE_LEVELS, n_iters=None):
+        """Trade flow quality for latency at runtime.
+
+        Args:
+            levels (int): number of pyramid levels refined, from the finest one (full
+                resolution) up. The IFNet flow (1/2 resolution) is scaled to the coarsest
+                refined level, with 0 it is only upsampled, like FlowRefineNet_Multis_Simple
+                does. Default: 4
+            n_iters (int | None): refinement iterations per level, None for the ones the
+                blocks were built with. Default: None
+        """
+        assert 0 <= levels <= REFINE_LEVELS, 'refine levels must be in [0, %d]' % REFINE_LEVELS
+        self.refine_levels = levels
+        self.refine_iters = n_iters
+
+    def refine_flow(self, c0, c1, flow):
+        rf_blocks = [self.rf_block1, self.rf_block2, self.rf_block3, self.rf_block4]
+
+        # update flow from small scale, level i runs at 1/2^i of the input resolution
+        scale = 2. ** (2 - max(self.refine_levels, 1))
+        if scale != 1:
+            flow = F.interpolate(flow, scale_factor=scale, mode="bilinear", align_corners=False) * scale
+        for i in reversed(range(self.refine_levels)):
+            flow = rf_blocks[i](c0[i], c1[i], flow[:, :2], flow[:, 2:4], self.refine_iters)
+            if i > 0:
+                flow = F.interpolate(flow, scale_factor=2., mode="bilinear", align_corners=False) * 2.
 
-        inp = torch.cat([x0, x1], dim=0)
-        s_1 = self.conv1(inp)  # 1
-        s_2 = self.conv2(s_1)  # 1/2
-        s_3 = self.conv3(s_2)  # 1/4
-        s_4 = self.conv4(s_3)  # 1/8
+        return flow
 
-        # update flow from small scale
-        flow = F.interpolate(flow, scale_factor=0.25, mode="bilinear", align_corners=False) * 0.25  # 1/8
-        flow = self.rf_block4(s_4[:bs], s_4[bs:], flow[:, :2], flow[:, 2:4])  # 1/8
-        flow = F.interpolate(flow, scale_factor=2., mode="bilinear", align_corners=False) * 2.
-        flow = self.rf_block3(s_3[:bs], s_3[bs:], flow[:, :2], flow[:, 2:4])  # 1/4
-        flow = F.interpolate(flow, scale_factor=2., mode="bilinear", align_corners=False) * 2.
-        flow = self.rf_block2(s_2[:bs], s_2[bs:], flow[:, :2], flow[:, 2:4])  # 1/2
-        flow = F.interpolate(flow, scale_factor=2., mode="bilinear", align_corners=False) * 2.
-        flow = self.rf_block1(s_1[:bs], s_1[bs:], flow[:, :2], flow[:, 2:4])  # 1
+    def forward(self, x0, x1, flow, feas0=None, feas1=None):
+        bs = x0.size(0)
+        feas = self.get_stacked_features(x0, x1, feas0, feas1)
+        flow = self.refine_flow([s[:bs] for s in feas], [s[bs:] for s in feas], flow)
 
         # warp features by the updated flow
-        c0 = [s_1[:bs], s_2[:bs], s_3[:bs], s_4[:bs]]
-        c1 = [s_1[bs:], s_2[bs:], s_3[bs:], s_4[bs:]]
-        out0 = self.warp_fea(c0, flow[:, :2])
-        out1 = self.warp_fea(c1, flow[:, 2:4])
+        out0, out1 = self.warp_fea(feas, flow)
 
         return flow, out0, out1
 
-    def warp_fea(self, feas, flow):
-        outs = []
+    def warp_fea(self, feas, flow, imgs=None):
+        # feas (and imgs) hold both frames stacked along the batch and both directions of the
+        # flow are stacked the same way, so every level takes one grid_sample and one downscale
+        # of the flow. The warped imgs come first in the returned lists
+        bs = flow.size(0)
+        flow = torch.cat([flow[:, :2], flow[:, 2:4]], dim=0)
+        outs = [] if imgs is None else [warp(imgs, flow)]
         for i, fea in enumerate(feas):
-            out = warp(fea, flow)
-            outs.append(out)
-            flow = F.interpolate(flow, scale_factor=0.5, mode="bilinear", align_corners=False) * 0.5
-        return outs
+            outs.append(warp(fea, flow))
+            if i < len(feas) - 1:
+                flow = F.interpolate(flow, scale_factor=0.5, mode="bilinear", align_corners=False) * 0.5
+        return [out[:bs] for out in outs], [out[bs:] for out in outs]
 
 
 
@@ -338,7 +455,11 @@ class VFIformer(nn.Module):
                                                       [[False, False, False, False], [True, True, True, True]], \
                                                       [[False, False, False, False], [True, True, True, True]], \
                                                       [[False, False, False, False], [False, False, False, False]]])
-
+        self.transformer.set_attn_backend(getattr(args, 'attn_backend', 'math'))
+        self.refinenet.set_refine(getattr(args, 'refine_levels', REFINE_LEVELS), getattr(args, 'refine_iters', 0) or None)
+        self.precision = getattr(args, 'precision', 'fp32')
+        self.flow_scale = getattr(args, 'flow_scale', 1.)
+        assert self.precision in PRECISIONS, 'unknown precision: %s' % self.precision
 
         self.apply(self._init_weights)
 
@@ -373,27 +494,44 @@ class VFIformer(nn.Module):
             nn.init.constant_(m.weight, 1.0)
 
     def get_flow(self, img0, img1):
-        imgs = torch.cat((img0, img1), 1)
-        flow, flow_list = self.flownet(imgs)
-        flow, c0, c1 = self.refinenet(img0, img1, flow)
+        with autocast(img0, self.precision):
+            imgs = torch.cat((img0, img1), 1)
+            flow, flow_list = self.flownet(imgs)
+            feas0, feas1 = self.refinenet.get_pair_features(img0, img1)
+            flow = self.refinenet.refine_flow(feas0, feas1, flow)
 
         return flow
 
-    def forward(self, img0, img1, flow_pre=None):
-        B, _, H, W = img0.size()
-        imgs = torch.cat((img0, img1), 1)
+    def get_features(self, img):
+        with autocast(img, self.precision):
+            return self.refinenet.get_features(img)
+
+    def forward(self, img0, img1, flow_pre=None, feas0=None, feas1=None):
+        with autocast(img0, self.precision):
+            B, _, H, W = img0.size()
+            imgs = torch.cat((img0, img1), 1)
+            if flow_pre is None and self.phase != 'train':
+                flow_scale = pick_flow_scale(self.flow_scale, H, W)
+                if flow_scale != 1:
+                    flow_pre = get_flow_scaled(self, img0, img1, flow_scale)
+
+            feas = self.refinenet.get_stacked_features(img0, img1, feas0, feas1)
+            if flow_pre is not None:
+                flow = flow_pre
+            else:
+                flow, flow_list = self.flownet(imgs)
+                flow = self.refinenet.refine_flow([s[:B] for s in feas], [s[B:] for s in feas], flow)
 
-        if flow_pre is not None:
-            flow = flow_pre
-            _, c0, c1 = self.refinenet.get_context(img0, img1, flow)
-        else:
-            flow, flow_list = self.flownet(imgs)
-            flow, c0, c1 = self.refinenet(img0, img1, flow)
+            # the images are warped with the same stacked flows as the context features
+            c0, c1 = self.refinenet.warp_fea(feas, flow, torch.cat((img0, img1), 0))
+            pred = self.synthesize(img0, img1, c0[0], c1[0], c0[1:], c1[1:])
 
+        if self.phase == 'train':
+            return pred, flow_list
+        else:
+            return pred, flow
 
-        warped_img0 = warp(img0, flow[:, :2])
-        warped_img1 = warp(img1, flow[:, 2:])
-        
+    def synthesize(self, img0, img1, warped_img0, warped_img1, c0, c1):
         x = self.fuse_block(torch.cat([img0, img1, warped_img0, warped_img1], dim=1))
 
         refine_output = self.transformer(x, c0, c1)
@@ -403,10 +541,42 @@ class VFIformer(nn.Module):
         pred = merged_img + res
         pred = torch.clamp(pred, 0, 1)
 
-        if self.phase == 'train':
-            return pred, flow_list
-        else:
-            return pred, flow
+        return pred
+
+    def forward_multi(self, img0, img1, timesteps, flow_pre=None, feas0=None, feas1=None):
+        """Synthesize several intermediate frames of one input pair.
+
+        The bidirectional flow and the context pyramids are computed once, the
+        flow towards each timestep is obtained by linearly scaling the flow of the
+        midpoint, and only the fusion block and the transformer run per timestep.
+
+        Args:
+            timesteps (list[float]): timesteps in (0, 1), 0.5 is the midpoint.
+
+        Returns:
+            list[Tensor]: one (B, 3, H, W) prediction per timestep.
+        """
+        with autocast(img0, self.precision):
+            B, _, H, W = img0.size()
+            if flow_pre is None and self.phase != 'train':
+                flow_scale = pick_flow_scale(self.flow_scale, H, W)
+                if flow_scale != 1:
+                    flow_pre = get_flow_scaled(self, img0, img1, flow_scale)
+            feas = self.refinenet.get_stacked_features(img0, img1, feas0, feas1)
+            if flow_pre is not None:
+                flow = flow_pre
+            else:
+                flow, flow_list = self.flownet(torch.cat((img0, img1), 1))
+                flow = self.refinenet.refine_flow([s[:B] for s in feas], [s[B:] for s in feas], flow)
+
+            imgs = torch.cat((img0, img1), 0)
+            preds = []
+            for t in timesteps:
+                flow_t = torch.cat([flow[:, :2] * (2 * t), flow[:, 2:] * (2 * (1 - t))], dim=1)
+                c0, c1 = self.refinenet.warp_fea(feas, flow_t, imgs)
+                preds.append(self.synthesize(img0, img1, c0[0], c1[0], c0[1:], c1[1:]))
+
+        return preds
 
 
 
@@ -424,32 +594,66 @@ class FlowRefineNet_Multis_Simple(nn.Module):
         self.conv3 = Conv2(2 * c, 4 * c)
         self.conv4 = Conv2(4 * c, 8 * c)
 
-    def forward(self, x0, x1, flow):
-        bs = x0.size(0)
-
-        inp = torch.cat([x0, x1], dim=0)
-        s_1 = self.conv1(inp)  # 1
+    def get_features(self, x):
+        s_1 = self.conv1(x)  # 1
         s_2 = self.conv2(s_1)  # 1/2
         s_3 = self.conv3(s_2)  # 1/4
         s_4 = self.conv4(s_3)  # 1/8
 
-        flow = F.interpolate(flow, scale_factor=2., mode="bilinear", align_corners=False) * 2.
+        return [s_1, s_2, s_3, s_4]
+
+    def get_pair_features(self, x0, x1, feas0=None, feas1=None):
+        if feas0 is None and feas1 is None:
+            bs = x0.size(0)
+            feas = self.get_features(torch.cat([x0, x1], dim=0))
+            return [s[:bs] for s in feas], [s[bs:] for s in feas]
+        if feas0 is None:
+            feas0 = self.get_features(x0)
+        if feas1 is None:
+            feas1 = self.get_features(x1)
+
+        return feas0, feas1
+
+    def get_stacked_features(self, x0, x1, feas0=None, feas1=None):
+        # pyramids of x0 and x1 stacked along the batch, the layout warp_fea works on
+        if feas0 is None and feas1 is None:
+            return self.get_features(torch.cat([x0, x1], dim=0))
+        feas0, feas1 = self.get_pair_features(x0, x1, feas0, feas1)
+        return [torch.cat([s0, s1], dim=0) for s0, s1 in zip(feas0, feas1)]
+
+    def refine_flow(self, c0, c1, flow):
+        return F.interpolate(flow, scale_factor=2., mode="bilinear", align_corners=False) * 2.
+
+    def get_context(self, x0, x1, flow, feas0=None, feas1=None):
+        feas = self.get_stacked_features(x0, x1, feas0, feas1)
+
+        # warp features by the given flow
+        out0, out1 = self.warp_fea(feas, flow)
+
+        return flow, out0, out1
+
+    def forward(self, x0, x1, flow, feas0=None, feas1=None):
+        bs = x0.size(0)
+        feas = self.get_stacked_features(x0, x1, feas0, feas1)
+        flow = self.refine_flow([s[:bs] for s in feas], [s[bs:] for s in feas], flow)
 
         # warp features by the updated flow
-        c0 = [s_1[:bs], s_2[:bs], s_3[:bs], s_4[:bs]]
-        c1 = [s_1[bs:], s_2[bs:], s_3[bs:], s_4[bs:]]
-        out0 = self.warp_fea(c0, flow[:, :2])
-        out1 = self.warp_fea(c1, flow[:, 2:4])
+        out0, out1 = self.warp_fea(feas, flow)
 
         return flow, out0, out1
 
-    def warp_fea(self, feas, flow):
-        outs = []
+    def warp_fea(self, feas, flow, imgs=None):
+        # feas (and imgs) hold both frames stacked along the batch and both directions of the
+        # flow are stacked the same way, so every level takes one grid_sample and one downscale
+        # of the flow. The warped imgs come first in the returned lists
+        bs = flow.size(0)
+        flow = torch.cat([flow[:, :2], flow[:, 2:4]], dim=0)
+        outs = [] if imgs is None else [warp(imgs, flow)]
         for i, fea in enumerate(feas):
-            out = warp(fea, flow)
-            outs.append(out)
-            flow = F.interpolate(flow, scale_factor=0.5, mode="bilinear", align_corners=False) * 0.5
-        return outs
+            outs.append(warp(fea, flow))
+            if i < len(feas) - 1:
+                flow = F.interpolate(flow, scale_factor=0.5, mode="bilinear", align_corners=False) * 0.5
+        return [out[:bs] for out in outs], [out[bs:] for out in outs]
 
 
 
@@ -480,7 +684,10 @@ class VFIformerSmall(nn.Module):
                                                       [[False, False, False, False], [True, True, True, True]], \
                                                       [[False, False, False, False], [True, True, True, True]], \
                                                       [[False, False, False, False], [False, False, False, False]]])
-
+        self.transformer.set_attn_backend(getattr(args, 'attn_backend', 'math'))
+        self.precision = getattr(args, 'precision', 'fp32')
+        self.flow_scale = getattr(args, 'flow_scale', 1.)
+        assert self.precision in PRECISIONS, 'unknown precision: %s' % self.precision
 
         self.apply(self._init_weights)
 
@@ -515,28 +722,44 @@ class VFIformerSmall(nn.Module):
             nn.init.constant_(m.weight, 1.0)
 
     def get_flow(self, img0, img1):
-        imgs = torch.cat((img0, img1), 1)
-        flow, flow_list = self.flownet(imgs)
-        flow, c0, c1 = self.refinenet(img0, img1, flow)
+        with autocast(img0, self.precision):
+            imgs = torch.cat((img0, img1), 1)
+            flow, flow_list = self.flownet(imgs)
+            feas0, feas1 = self.refinenet.get_pair_features(img0, img1)
+            flow = self.refinenet.refine_flow(feas0, feas1, flow)
 
         return flow
 
-    def forward(self, img0, img1, flow_pre=None):
-        B, _, H, W = img0.size()
-        imgs = torch.cat((img0, img1), 1)
+    def get_features(self, img):
+        with autocast(img, self.precision):
+            return self.refinenet.get_features(img)
+
+    def forward(self, img0, img1, flow_pre=None, feas0=None, feas1=None):
+        with autocast(img0, self.precision):
+            B, _, H, W = img0.size()
+            imgs = torch.cat((img0, img1), 1)
+            if flow_pre is None and self.phase != 'train':
+                flow_scale = pick_flow_scale(self.flow_scale, H, W)
+                if flow_scale != 1:
+                    flow_pre = get_flow_scaled(self, img0, img1, flow_scale)
+
+            feas = self.refinenet.get_stacked_features(img0, img1, feas0, feas1)
+            if flow_pre is not None:
+                flow = flow_pre
+            else:
+                flow, flow_list = self.flownet(imgs)
+                flow = self.refinenet.refine_flow([s[:B] for s in feas], [s[B:] for s in feas], flow)
 
-        if flow_pre is not None:
-            flow = flow_pre
-            _, c0, c1 = self.refinenet(img0, img1, flow)
+            # the images are warped with the same stacked flows as the context features
+            c0, c1 = self.refinenet.warp_fea(feas, flow, torch.cat((img0, img1), 0))
+            pred = self.synthesize(img0, img1, c0[0], c1[0], c0[1:], c1[1:])
 
+        if self.phase == 'train':
+            return pred, flow_list
         else:
-            flow, flow_list = self.flownet(imgs)
-            flow, c0, c1 = self.refinenet(img0, img1, flow)
-
+            return pred, flow
 
-        warped_img0 = warp(img0, flow[:, :2])
-        warped_img1 = warp(img1, flow[:, 2:])
-        
+    def synthesize(self, img0, img1, warped_img0, warped_img1, c0, c1):
         x = self.fuse_block(torch.cat([img0, img1, warped_img0, warped_img1], dim=1))
 
         refine_output = self.transformer(x, c0, c1)
@@ -546,10 +769,42 @@ class VFIformerSmall(nn.Module):
         pred = merged_img + res
         pred = torch.clamp(pred, 0, 1)
 
-        if self.phase == 'train':
-            return pred, flow_list
-        else:
-            return pred, flow
+        return pred
+
+    def forward_multi(self, img0, img1, timesteps, flow_pre=None, feas0=None, feas1=None):
+        """Synthesize several intermediate frames of one input pair.
+
+        The bidirectional flow and the context pyramids are computed once, the
+        flow towards each timestep is obtained by linearly scaling the flow of the
+        midpoint, and only the fusion block and the transformer run per timestep.
+
+        Args:
+            timesteps (list[float]): timesteps in (0, 1), 0.5 is the midpoint.
+
+        Returns:
+            list[Tensor]: one (B, 3, H, W) prediction per timestep.
+        """
+        with autocast(img0, self.precision):
+            B, _, H, W = img0.size()
+            if flow_pre is None and self.phase != 'train':
+                flow_scale = pick_flow_scale(self.flow_scale, H, W)
+                if flow_scale != 1:
+                    flow_pre = get_flow_scaled(self, img0, img1, flow_scale)
+            feas = self.refinenet.get_stacked_features(img0, img1, feas0, feas1)
+            if flow_pre is not None:
+                flow = flow_pre
+            else:
+                flow, flow_list = self.flownet(torch.cat((img0, img1), 1))
+                flow = self.refinenet.refine_flow([s[:B] for s in feas], [s[B:] for s in feas], flow)
+
+            imgs = torch.cat((img0, img1), 0)
+            preds = []
+            for t in timesteps:
+                flow_t = torch.cat([flow[:, :2] * (2 * t), flow[:, 2:] * (2 * (1 - t))], dim=1)
+                c0, c1 = self.refinenet.warp_fea(feas, flow_t, imgs)
+                preds.append(self.synthesize(img0, img1, c0[0], c1[0], c0[1:], c1[1:]))
+
+        return preds
 
 
 
@@ -12,6 +12,23 @@ import torch.utils.checkpoint as checkpoint
 from timm.models.layers import DropPath, to_2tuple, trunc_normal_
 sys.path.append('../..')
 from models.archs.warplayer import warp
+from utils.util import LRUCache, is_compiling
+
+# attention masks of inputs whose size differs from the training resolution, shared by all
+# the blocks with the same window geometry (at 1080p the full-resolution masks take ~0.5GB each),
+# bounded by their total size so long-lived processes do not keep GBs of 4K masks around
+MASK_CACHE_SIZE = 16
+MASK_CACHE_BYTES = 1 << 30
+mask_cache = LRUCache(MASK_CACHE_SIZE, max_bytes=MASK_CACHE_BYTES)
+
+# 'math': explicit softmax(q @ k^T + bias + mask) @ v
+# 'sdpa': F.scaled_dot_product_attention with bias + mask as attn_mask, never keeps the
+#         (nW*B, nH, N, N) attention matrix around
+ATTN_BACKENDS = ('math', 'sdpa')
+
+# upper bound of the dense bias + mask the sdpa backend builds per call, larger masks are
+# built and attended in chunks of windows
+SDPA_MASK_CHUNK_BYTES = 1 << 28
 
 class Mlp(nn.Module):
     def __init__(self, in_features, hidden_features=None, out_features=None, act_layer=nn.GELU, drop=0.):
@@ -47,6 +64,58 @@ def window_partition(x, window_size):
     return windows
 
 
+def get_relative_position_bias(attn, table_name):
+    """Gather the (nH, Wh*Ww, Wh*Ww) relative position bias of an attention module.
+
+    The gathered bias only changes with its table, so outside of autograd it is kept
+    and reused until the table is updated in place, moved or reloaded.
+    """
+    table = getattr(attn, table_name)
+    if attn.training or torch.is_grad_enabled() or is_compiling():
+        return gather_relative_position_bias(table, attn.relative_position_index, attn.window_size)
+
+    key = (table.device, table.dtype, table._version)
+    cached = attn.bias_cache.get(table_name)
+    if cached is None or cached[0] != key:
+        cached = (key, gather_relative_position_bias(table, attn.relative_position_index, attn.window_size))
+        attn.bias_cache[table_name] = cached
+    return cached[1]
+
+
+def gather_relative_position_bias(table, relative_position_index, window_size):
+    relative_position_bias = table[relative_position_index.view(-1)].view(
+        window_size[0] * window_size[1], window_size[0] * window_size[1], -1)  # Wh*Ww,Wh*Ww,nH
+    return relative_position_bias.permute(2, 0, 1).contiguous()  # nH, Wh*Ww, Wh*Ww
+
+
+def sdpa_window_attention(q, k, v, bias, mask, scale, dropout_p=0.):
+    """Window attention through F.scaled_dot_product_attention.
+
+    Args:
+        q, k, v: (num_windows*B, nH, N, head_dim)
+        bias: (nH, N, N) relative position bias
+        mask: (num_windows, N, N) (0/-inf) mask or None
+    """
+    bias = bias.to(q.dtype)
+    if mask is None:
+        return F.scaled_dot_product_attention(q, k, v, attn_mask=bias.unsqueeze(0), dropout_p=dropout_p, scale=scale)
+
+    # split num_windows*B so the per-window mask broadcasts over the batch
+    B_, nH, N, d = q.shape
+    nW = mask.shape[0]
+    q, k, v = (t.reshape(B_ // nW, nW, nH, N, d) for t in (q, k, v))
+
+    # bias + mask is dense, build it for a chunk of windows at a time so it stays small at any resolution
+    chunk = nW if is_compiling() else max(1, SDPA_MASK_CHUNK_BYTES // (nH * N * N * q.element_size()))
+    x = []
+    for i in range(0, nW, chunk):
+        attn_mask = bias.unsqueeze(0) + mask[i:i + chunk].to(q.dtype).unsqueeze(1)  # nWc, nH, N, N
+        x.append(F.scaled_dot_product_attention(q[:, i:i + chunk], k[:, i:i + chunk], v[:, i:i + chunk],
+                                                attn_mask=attn_mask, dropout_p=dropout_p, scale=scale))
+    x = x[0] if len(x) == 1 else torch.cat(x, dim=1)
+    return x.reshape(B_, nH, N, d)
+
+
 def window_reverse(windows, window_size, H, W):
     """
     Args:
@@ -112,6 +181,12 @@ class WindowAttention(nn.Module):
 
         trunc_normal_(self.relative_position_bias_table, std=.02)
         self.softmax = nn.Softmax(dim=-1)
+        self.bias_cache = {}
+        self.attn_backend = 'math'
+
+    def _load_from_state_dict(self, *args, **kwargs):
+        self.bias_cache.clear()
+        super()._load_from_state_dict(*args, **kwargs)
 
     def forward(self, x, mask=None):
         """
@@ -123,21 +198,28 @@ class WindowAttention(nn.Module):
         qkv = self.qkv(x).reshape(B_, N, 3, self.num_heads, C // self.num_heads).permute(2, 0, 3, 1, 4)
         q, k, v = qkv[0], qkv[1], qkv[2]  # make torchscript happy (cannot use tensor as tuple)
 
+        if self.attn_backend == 'sdpa':
+            relative_position_bias = get_relative_position_bias(self, 'relative_position_bias_table')
+            x = sdpa_window_attention(q, k, v, relative_position_bias, mask, self.scale,
+                                      self.attn_drop.p if self.training else 0.)
+            x = self.proj(x.transpose(1, 2).reshape(B_, N, C))
+            x = self.proj_drop(x)
+            return x
+
         q = q * self.scale
         attn = (q @ k.transpose(-2, -1).contiguous())
 
-        relative_position_bias = self.relative_position_bias_table[self.relative_position_index.view(-1)].view(
-            self.window_size[0] * self.window_size[1], self.window_size[0] * self.window_size[1], -1)  # Wh*Ww,Wh*Ww,nH
-        relative_position_bias = relative_position_bias.permute(2, 0, 1).contiguous()  # nH, Wh*Ww, Wh*Ww
+        # the softmax below runs in fp32 also under autocast
+        relative_position_bias = get_relative_position_bias(self, 'relative_position_bias_table')  # nH, Wh*Ww, Wh*Ww
         attn = attn + relative_position_bias.unsqueeze(0)
 
         if mask is not None:
             nW = mask.shape[0]
             attn = attn.view(B_ // nW, nW, self.num_heads, N, N) + mask.unsqueeze(1).unsqueeze(0)
             attn = attn.view(-1, self.num_heads, N, N)
-            attn = self.softmax(attn)
+            attn = self.softmax(attn.float())
         else:
-            attn = self.softmax(attn)
+            attn = self.softmax(attn.float())
 
         attn = self.attn_drop(attn)
 
@@ -219,6 +301,12 @@ class WindowCrossAttention(nn.Module):
         trunc_normal_(self.relative_position_bias_table_x, std=.02)
         trunc_normal_(self.relative_position_bias_table_y, std=.02)
         self.softmax = nn.Softmax(dim=-1)
+        self.bias_cache = {}
+        self.attn_backend = 'math'
+
+    def _load_from_state_dict(self, *args, **kwargs):
+        self.bias_cache.clear()
+        super()._load_from_state_dict(*args, **kwargs)
 
     def forward(self, x, y, mask_x=None, mask_y=None):
         """
@@ -226,6 +314,9 @@ class WindowCrossAttention(nn.Module):
             x: input features with shape of (num_windows*B, N, C)
             mask: (0/-inf) mask with shape of (num_windows, Wh*Ww, Wh*Ww) or None
         """
+        if self.attn_backend == 'sdpa':
+            return self.forward_sdpa(x, y, mask_x, mask_y)
+
         B_, N, C = x.shape
         qkv = self.qkv(x).reshape(B_, N, 3, self.num_heads, C // self.num_heads).permute(2, 0, 3, 1, 4)
         q, k, v = qkv[0], qkv[1], qkv[2]  # make torchscript happy (cannot use tensor as tuple)
@@ -233,18 +324,16 @@ class WindowCrossAttention(nn.Module):
         q = q * self.scale
         attn = (q @ k.transpose(-2, -1).contiguous())
 
-        relative_position_bias = self.relative_position_bias_table_x[self.relative_position_index.view(-1)].view(
-            self.window_size[0] * self.window_size[1], self.window_size[0] * self.window_size[1], -1)  # Wh*Ww,Wh*Ww,nH
-        relative_position_bias = relative_position_bias.permute(2, 0, 1).contiguous()  # nH, Wh*Ww, Wh*Ww
+        relative_position_bias = get_relative_position_bias(self, 'relative_position_bias_table_x')  # nH, Wh*Ww, Wh*Ww
         attn = attn + relative_position_bias.unsqueeze(0)
 
         if mask_x is not None:
             nW = mask_x.shape[0]
             attn = attn.view(B_ // nW, nW, self.num_heads, N, N) + mask_x.unsqueeze(1).unsqueeze(0)
             attn = attn.view(-1, self.num_heads, N, N)
-            attn = self.softmax(attn)
+            attn = self.softmax(attn.float())
         else:
-            attn = self.softmax(attn)
+            attn = self.softmax(attn.float())
 
         attn = self.attn_drop(attn)
 
@@ -258,18 +347,16 @@ class WindowCrossAttention(nn.Module):
 
         attn = (q @ k.transpose(-2, -1).contiguous())
 
-        relative_position_bias = self.relative_position_bias_table_y[self.relative_position_index.view(-1)].view(
-            self.window_size[0] * self.window_size[1], self.window_size[0] * self.window_size[1], -1)  # Wh*Ww,Wh*Ww,nH
-        relative_position_bias = relative_position_bias.permute(2, 0, 1).contiguous()  # nH, Wh*Ww, Wh*Ww
+        relative_position_bias = get_relative_position_bias(self, 'relative_position_bias_table_y')  # nH, Wh*Ww, Wh*Ww
         attn = attn + relative_position_bias.unsqueeze(0)
 
         if mask_y is not None:
             nW = mask_y.shape[0]
             attn = attn.view(B_ // nW, nW, self.num_heads, N, N) + mask_y.unsqueeze(1).unsqueeze(0)
             attn = attn.view(-1, self.num_heads, N, N)
-            attn = self.softmax(attn)
+            attn = self.softmax(attn.float())
         else:
-            attn = self.softmax(attn)
+            attn = self.softmax(attn.float())
 
         attn = self.attn_drop(attn)
 
@@ -281,6 +368,27 @@ class WindowCrossAttention(nn.Module):
         x = self.proj_drop(x)
         return x
 
+    def forward_sdpa(self, x, y, mask_x=None, mask_y=None):
+        # the self-attention of x and its cross-attention to y share the query
+        B_, N, C = x.shape
+        qkv = self.qkv(x).reshape(B_, N, 3, self.num_heads, C // self.num_heads).permute(2, 0, 3, 1, 4)
+        kv = self.kv(y).reshape(B_, N, 2, self.num_heads, C // self.num_heads).permute(2, 0, 3, 1, 4)
+        q = qkv[0]
+        dropout_p = self.attn_drop.p if self.training else 0.
+
+        x = sdpa_window_attention(q, qkv[1], qkv[2], get_relative_position_bias(self, 'relative_position_bias_table_x'),
+                                  mask_x, self.scale, dropout_p)
+        y = sdpa_window_attention(q, kv[0], kv[1], get_relative_position_bias(self, 'relative_position_bias_table_y'),
+                                  mask_y, self.scale, dropout_p)
+        x = x.transpose(1, 2).reshape(B_, N, C)
+        y = y.transpose(1, 2).reshape(B_, N, C)
+
+        x = self.merge2(self.act(self.merge1(torch.cat([x, y], dim=-1)))) + x
+
+        x = self.proj(x)
+        x = self.proj_drop(x)
+        return x
+
     def extra_repr(self) -> str:
         return f'dim={self.dim}, window_size={self.window_size}, num_heads={self.num_heads}'
 
@@ -413,6 +521,35 @@ class TFL(nn.Module):
         return attn_mask
 
 
+    def get_masks(self, x_size, device):
+        # masks of the training resolution are registered buffers
+        if self.input_resolution == x_size:
+            if not self.use_crossattn:
+                return self.attn_mask, None
+            return self.attn_mask_x, self.attn_mask_y
+
+        # without shift every window is contiguous and the masks are all zeros
+        if self.shift_size == 0:
+            return None, None
+
+        # compiled graphs keep the masks as constants, the cache would only break the graph
+        if is_compiling():
+            mask_y = self.calculate_mask2(x_size).to(device) if self.use_crossattn else None
+            return self.calculate_mask(x_size).to(device), mask_y
+
+        key = ('mask', x_size, self.window_size, self.shift_size, device)
+        mask_x = mask_cache.get(key)
+        if mask_x is None:
+            mask_x = mask_cache.put(key, self.calculate_mask(x_size).to(device))
+        if not self.use_crossattn:
+            return mask_x, None
+
+        key = ('mask2', x_size, self.window_size, self.shift_size, device)
+        mask_y = mask_cache.get(key)
+        if mask_y is None:
+            mask_y = mask_cache.put(key, self.calculate_mask2(x_size).to(device))
+        return mask_x, mask_y
+
     def forward(self, x, x_size):
         H, W = x_size
         B, L, C = x.shape
@@ -433,11 +570,9 @@ class TFL(nn.Module):
         x_windows = x_windows.view(-1, self.window_size * self.window_size, C)  # nW*B, window_size*window_size, C
 
         # W-MSA/SW-MSA (to be compatible for testing on images whose shapes are the multiple of window size
+        mask_x, mask_y = self.get_masks(x_size, x.device)
         if not self.use_crossattn:
-            if self.input_resolution == x_size:
-                attn_windows = self.attn(x_windows, mask=self.attn_mask)  # nW*B, window_size*window_size, C
-            else:
-                attn_windows = self.attn(x_windows, mask=self.calculate_mask(x_size).to(x.device))
+            attn_windows = self.attn(x_windows, mask=mask_x)  # nW*B, window_size*window_size, C
         else:
             shifted_x_down = F.interpolate(shifted_x.permute(0, 3, 1, 2).contiguous(), scale_factor=0.5, mode="bilinear", align_corners=False)
             shifted_x_down = F.pad(shifted_x_down, (self.window_size//4, self.window_size//4, self.window_size//4, self.window_size//4), mode='reflect')
@@ -445,10 +580,7 @@ class TFL(nn.Module):
             x_windows_down = x_windows_down.view(B, C, self.window_size*self.window_size, -1)
             x_windows_down = x_windows_down.permute(0, 3, 2, 1).contiguous().view(-1, self.window_size*self.window_size, C)  # nW*B, window_size*window_size, C
 
-            if self.input_resolution == x_size:
-                attn_windows = self.attn(x_windows, x_windows_down, mask_x=self.attn_mask_x, mask_y=self.attn_mask_y)  # nW*B, window_size*window_size, C
-            else:
-                attn_windows = self.attn(x_windows, x_windows_down, mask_x=self.calculate_mask(x_size).to(x.device), mask_y=self.calculate_mask2(x_size).to(x.device))
+            attn_windows = self.attn(x_windows, x_windows_down, mask_x=mask_x, mask_y=mask_y)  # nW*B, window_size*window_size, C
 
         # merge windows
         attn_windows = attn_windows.view(-1, self.window_size, self.window_size, C)
@@ -969,6 +1101,12 @@ class TFModel(nn.Module):
             nn.init.constant_(m.bias, 0)
             nn.init.constant_(m.weight, 1.0)
 
+    def set_attn_backend(self, attn_backend):
+        assert attn_backend in ATTN_BACKENDS, 'unknown attention backend: %s' % attn_backend
+        for m in self.modules():
+            if isinstance(m, (WindowAttention, WindowCrossAttention)):
+                m.attn_backend = attn_backend
+
     @torch.jit.ignore
     def no_weight_decay(self):
         return {'absolute_pos_embed'}
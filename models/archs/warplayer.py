@@ -1,24 +1,59 @@
 import torch
 import torch.nn as nn
+from utils.util import LRUCache, is_compiling
 
-device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
-backwarp_tenGrid = {}
+# batch independent base grids (and the flow scales of their size) per device, dtype and
+# size, every pyramid level, tile size and resolution of a long run gets its own entry
+GRID_CACHE_SIZE = 32
+backwarp_tenGrid = LRUCache(GRID_CACHE_SIZE)
 
 
 def warp(tenInput, tenFlow):
-    k = (str(tenFlow.device), str(tenFlow.size()))
-    if k not in backwarp_tenGrid:
-        tenHorizontal = torch.linspace(-1.0, 1.0, tenFlow.shape[3], device=device).view(
-            1, 1, 1, tenFlow.shape[3]).expand(tenFlow.shape[0], -1, tenFlow.shape[2], -1)
-        tenVertical = torch.linspace(-1.0, 1.0, tenFlow.shape[2], device=device).view(
-            1, 1, tenFlow.shape[2], 1).expand(tenFlow.shape[0], -1, -1, tenFlow.shape[3])
-        backwarp_tenGrid[k] = torch.cat(
-            [tenHorizontal, tenVertical], 1).to(device)
-
-    tenFlow = torch.cat([tenFlow[:, 0:1, :, :] / ((tenInput.shape[3] - 1.0) / 2.0),
-                         tenFlow[:, 1:2, :, :] / ((tenInput.shape[2] - 1.0) / 2.0)], 1)
-
-    g = (backwarp_tenGrid[k] + tenFlow).permute(0, 2, 3, 1)
+    # the grid arithmetic and the sampling always run in fp32, under autocast low precision
+    # offsets lose the sub-pixel part of the flow at high resolutions
+    with torch.autocast(device_type=tenInput.device.type, enabled=False):
+        output = warp_fp32(tenInput.float(), tenFlow.float())
+    return output.to(tenInput.dtype)
+
+
+def make_grid(tenFlow):
+    # same grid as the cached one, built from arange since exporters fold linspace into a constant
+    B, _, H, W = tenFlow.size()
+    tenHorizontal = torch.arange(W, device=tenFlow.device, dtype=tenFlow.dtype) * (2.0 / (W - 1)) - 1.0
+    tenVertical = torch.arange(H, device=tenFlow.device, dtype=tenFlow.dtype) * (2.0 / (H - 1)) - 1.0
+    return torch.stack([tenHorizontal.view(1, W).expand(H, -1),
+                        tenVertical.view(H, 1).expand(-1, W)], -1).unsqueeze(0)
+
+
+def get_grid(tenInput, tenFlow):
+    # (1, H, W, 2) base grid in grid_sample layout and the (2,) scale mapping flows in pixels of
+    # the input to offsets in [-1, 1] coordinates, both broadcast over the batch
+    H, W = tenFlow.shape[2:]
+    k = (tenFlow.device, tenFlow.dtype, H, W) + tuple(tenInput.shape[2:])
+    entry = backwarp_tenGrid.get(k)
+    if entry is None:
+        tenHorizontal = torch.linspace(-1.0, 1.0, W, device=tenFlow.device, dtype=tenFlow.dtype)
+        tenVertical = torch.linspace(-1.0, 1.0, H, device=tenFlow.device, dtype=tenFlow.dtype)
+        grid = torch.stack([tenHorizontal.view(1, W).expand(H, -1),
+                            tenVertical.view(H, 1).expand(-1, W)], -1).unsqueeze(0)
+        scale = torch.tensor([2.0 / (tenInput.shape[3] - 1.0), 2.0 / (tenInput.shape[2] - 1.0)],
+                             device=tenFlow.device, dtype=tenFlow.dtype)
+        entry = backwarp_tenGrid.put(k, (grid, scale))
+    return entry
+
+
+def warp_fp32(tenInput, tenFlow):
+    if is_compiling():
+        # compiled and exported graphs compute the grid for the size they run at
+        grid = make_grid(tenFlow)
+        tenFlow = torch.cat([tenFlow[:, 0:1, :, :] / ((tenInput.shape[3] - 1.0) / 2.0),
+                             tenFlow[:, 1:2, :, :] / ((tenInput.shape[2] - 1.0) / 2.0)], 1)
+        g = grid + tenFlow.permute(0, 2, 3, 1)
+    else:
+        grid, scale = get_grid(tenInput, tenFlow)
+        # grid + flow * scale in one op, without materializing the normalized flow
+        g = torch.addcmul(grid, tenFlow.permute(0, 2, 3, 1), scale)
+
     return torch.nn.functional.grid_sample(input=tenInput, grid=g, mode='bilinear', padding_mode='border', align_corners=True)
 
 
@@ -27,4 +62,4 @@ def flow_reversal(flow):
     B, _, H, W = flow.size()
     flow_r = warp(flow, flow.clone())
     flow_r = -1 * flow_r
-    return flow_r
\ No newline at end of file
+    return flow_r
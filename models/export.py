@@ -0,0 +1,170 @@
+import os
+import time
+import logging
+import warnings
+import torch
+import torch.nn as nn
+from models.inference import get_bare_model
+
+
+EXPORT_MODES = ('trace', 'compile')
+ONNX_DIVISOR = 64
+
+
+class InferenceModule(nn.Module):
+    """(img0, img1) -> pred view of VFIformer / VFIformerSmall.
+
+    Drops the training outputs and the optional arguments of the forward pass, so the
+    module can be traced or compiled for a fixed input shape.
+    """
+
+    def __init__(self, net):
+        super(InferenceModule, self).__init__()
+        self.net = get_bare_model(net)
+
+    def forward(self, img0, img1):
+        pred, _ = self.net(img0, img1, None)
+        return pred
+
+
+def get_variant(args):
+    # everything besides the weights that changes the exported graph
+    variant = '%s_%s_%s' % (args.net_name, args.precision, args.attn_backend)
+    if getattr(args, 'refine_levels', 4) != 4 or getattr(args, 'refine_iters', 0):
+        variant += '_refine%dx%d' % (args.refine_levels, args.refine_iters)
+    if getattr(args, 'flow_scale', 1.) != 1:
+        variant += '_flow%g' % args.flow_scale
+    return variant
+
+
+def get_export_path(args, shape):
+    # the artifact is stored next to the checkpoint and tied to everything it was traced with
+    root = os.path.splitext(args.resume)[0]
+    b, c, h, w = shape
+    return '%s_%s_%dx%dx%d.pt' % (root, get_variant(args), b, h, w)
+
+
+def trace_model(net, shape, device):
+    module = InferenceModule(net).eval()
+    example = torch.rand(shape, device=device)
+    with torch.no_grad(), warnings.catch_warnings():
+        # shape dependent branches (window masks, padding) are meant to be frozen for this shape
+        warnings.simplefilter('ignore', torch.jit.TracerWarning)
+        traced = torch.jit.trace(module, (example, example), check_trace=False)
+    return torch.jit.freeze(traced)
+
+
+def compile_model(net, args):
+    # inductor reuses the kernels built by earlier runs from its cache next to the checkpoint
+    os.environ.setdefault('TORCHINDUCTOR_CACHE_DIR', os.path.join(os.path.dirname(os.path.abspath(args.resume)), 'compile_cache'))
+    return torch.compile(InferenceModule(net).eval(), dynamic=False)
+
+
+class ExportedModel(object):
+    """Runs the (img0, img1) -> (pred, None) call of the network through exported modules.
+
+    In 'trace' mode there is one frozen TorchScript module per input shape, loaded from
+    next to the checkpoint when it was exported before and traced (and saved) on first
+    use otherwise. In 'compile' mode a single torch.compile'd module specializes itself
+    per input shape. Inputs are padded to a multiple of 64 by the callers, so the number
+    of shapes stays small.
+
+    Args:
+        net: VFIformer or VFIformerSmall with its weights loaded.
+        args: the args the network was built with, args.resume locates the artifacts.
+        mode (str): 'trace' | 'compile'. Default: 'trace'
+    """
+
+    def __init__(self, net, args, mode='trace'):
+        assert mode in EXPORT_MODES, 'unknown export mode: %s' % mode
+        self.net = get_bare_model(net).eval()
+        self.args = args
+        self.mode = mode
+        self.modules = {}
+        if mode == 'compile':
+            self.compiled = compile_model(self.net, args)
+
+    def get_module(self, shape, device):
+        if self.mode == 'compile':
+            return self.compiled
+
+        shape = tuple(shape)
+        if shape not in self.modules:
+            path = get_export_path(self.args, shape)
+            if os.path.exists(path):
+                self.modules[shape] = torch.jit.load(path, map_location=device)
+                logging.info('loaded exported model: %s' % path)
+            else:
+                start = time.time()
+                self.modules[shape] = trace_model(self.net, shape, device)
+                torch.jit.save(self.modules[shape], path)
+                logging.info('exported model in %.2fs: %s' % (time.time() - start, path))
+
+        return self.modules[shape]
+
+    def __call__(self, img0, img1, flow_pre=None):
+        assert flow_pre is None, 'exported models estimate the flow themselves'
+        with torch.no_grad():
+            pred = self.get_module(img0.shape, img0.device)(img0, img1)
+        return pred, None
+
+
+def get_onnx_path(args):
+    # one file covers every input size
+    root = os.path.splitext(args.resume)[0]
+    return '%s_%s.onnx' % (root, get_variant(args))
+
+
+def export_onnx(net, path, device, height=256, width=256):
+    """Export the pair forward to ONNX with dynamic H and W (multiples of 64) and a batch of 1.
+
+    The grid of warp and the shifted-window masks are computed in the graph from the
+    input size, so a single file serves every resolution. Needs the onnx and onnxscript
+    packages.
+    """
+    from torch.export import Dim
+
+    module = InferenceModule(net).eval()
+    # two distinct tensors, the exporter would alias img1 to img0 if the same one was passed twice
+    img0 = torch.rand((1, 3, height, width), device=device)
+    img1 = torch.rand((1, 3, height, width), device=device)
+    h = Dim('h', min=1, max=256)
+    w = Dim('w', min=1, max=256)
+    dynamic_shapes = {'img0': {2: ONNX_DIVISOR * h, 3: ONNX_DIVISOR * w},
+                      'img1': {2: ONNX_DIVISOR * h, 3: ONNX_DIVISOR * w}}
+    start = time.time()
+    with torch.no_grad():
+        # the onnxscript optimizer folds the `+ 1e-12` of FlowRefineNetA.L2normalize away,
+        # which turns the normalization of all-zero features into 0/0, so it is left off
+        # and the graph optimizations are left to the runtime
+        torch.onnx.export(module, (img0, img1), path, dynamo=True, optimize=False,
+                          dynamic_shapes=dynamic_shapes, input_names=['img0', 'img1'], output_names=['pred'])
+    logging.info('exported onnx model in %.2fs: %s' % (time.time() - start, path))
+
+
+class ORTModel(object):
+    """Runs the (img0, img1) -> (pred, None) call of the network with ONNX Runtime.
+
+    Args:
+        path (str): model exported by export_onnx.
+        num_threads (int): intra-op threads of the session, 0 for the runtime default.
+            Default: 0
+    """
+
+    def __init__(self, path, num_threads=0):
+        import onnxruntime as ort
+
+        options = ort.SessionOptions()
+        options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+        if num_threads:
+            options.intra_op_num_threads = num_threads
+        self.session = ort.InferenceSession(path, options, providers=['CPUExecutionProvider'])
+
+    def __call__(self, img0, img1, flow_pre=None):
+        assert flow_pre is None, 'exported models estimate the flow themselves'
+        # the graph is exported for a batch of 1, larger batches run pair by pair
+        preds = []
+        for i in range(img0.size(0)):
+            inputs = {'img0': img0[i:i+1].detach().cpu().numpy(), 'img1': img1[i:i+1].detach().cpu().numpy()}
+            preds.append(torch.from_numpy(self.session.run(['pred'], inputs)[0]))
+        return torch.cat(preds, 0).to(img0.device), None
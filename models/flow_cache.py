@@ -0,0 +1,169 @@
+import os
+import hashlib
+import numpy as np
+import torch
+import torch.nn.functional as F
+from utils.flowlib import read_flow
+from models.inference import get_bare_model
+from models.archs.VFIformer_arch import get_flow_scaled, pick_flow_scale
+
+
+def update_hash(h, value):
+    # weights, buffers and the packed params of quantized layers of a state dict
+    if torch.is_tensor(value):
+        value = value.detach().cpu()
+        if value.is_quantized:
+            value = value.int_repr()
+        h.update(str((value.dtype, tuple(value.shape))).encode())
+        h.update(value.contiguous().view(-1).view(torch.uint8).numpy().tobytes())
+    elif isinstance(value, (tuple, list)):
+        for v in value:
+            update_hash(h, v)
+    else:
+        h.update(repr(value).encode())
+
+
+def get_model_key(net):
+    # checksum of the weights and of every setting that changes the estimated flow
+    net = get_bare_model(net)
+    h = hashlib.sha1()
+    settings = (type(net).__name__, getattr(net, 'precision', 'fp32'), getattr(net, 'flow_scale', 1.),
+                getattr(net.refinenet, 'refine_levels', None), getattr(net.refinenet, 'refine_iters', None))
+    h.update(repr(settings).encode())
+    for k, v in net.state_dict().items():
+        h.update(k.encode())
+        update_hash(h, v)
+    return h.hexdigest()[:16]
+
+
+def get_pair_key(img0, img1):
+    # (3, H, W) inputs as they are fed to the network, after padding, hashed as the uint8
+    # frames they were decoded from, a quarter of the bytes of the float tensors to copy and hash
+    h = hashlib.sha1()
+    for img in (img0, img1):
+        img = img.detach().mul(255.).round_().clamp_(0, 255).byte().cpu().contiguous()
+        h.update(str(tuple(img.shape)).encode())
+        h.update(img.numpy().tobytes())
+    return h.hexdigest()
+
+
+def estimate_flow(net, img0, img1, flow_scale=None):
+    # the flow forward would compute for the pair, including the flow_scale of the network
+    net = get_bare_model(net)
+    if flow_scale is None:
+        flow_scale = pick_flow_scale(getattr(net, 'flow_scale', 1.), img0.size(2), img0.size(3))
+    with torch.no_grad():
+        return get_flow_scaled(net, img0, img1, flow_scale).float()
+
+
+class FlowCache(object):
+    """On-disk cache of the bidirectional flows estimated by the network.
+
+    A flow is stored as a (4, H, W) float32 .npy file per pair, under a folder per
+    model checksum, named by the hash of the pair content. Re-running the same footage
+    with other synthesis settings then skips the IFNet and the flow refinement.
+
+    Args:
+        root (str): folder of the cache, created if needed.
+        net: VFIformer or VFIformerSmall with its weights loaded.
+    """
+
+    def __init__(self, root, net):
+        self.net = get_bare_model(net)
+        self.root = os.path.join(root, get_model_key(self.net))
+        os.makedirs(self.root, exist_ok=True)
+        self.hits = 0
+        self.misses = 0
+
+    def get_path(self, img0, img1, flow_scale=None):
+        suffix = '' if flow_scale is None else '_%g' % flow_scale
+        return os.path.join(self.root, get_pair_key(img0, img1) + suffix + '.npy')
+
+    def get_flow(self, img0, img1, flow_scale=None):
+        """(B, 4, H, W) flows of a batch, loaded per pair or estimated and stored on a miss.
+
+        flow_scale overrides the flow estimation scale of the network, e.g. the down_scale
+        of tiled_forward, its flows are stored separately.
+        """
+        paths = [self.get_path(img0[k], img1[k], flow_scale) for k in range(img0.size(0))]
+        flows = [None] * len(paths)
+        missing = []
+        for k, path in enumerate(paths):
+            if os.path.exists(path):
+                flows[k] = torch.from_numpy(np.load(path)).to(img0.device)
+            else:
+                missing.append(k)
+        self.hits += len(paths) - len(missing)
+        self.misses += len(missing)
+
+        if missing:
+            flow = estimate_flow(self.net, img0[missing], img1[missing], flow_scale)
+            for i, k in enumerate(missing):
+                flows[k] = flow[i]
+                # written under a temporary name first, concurrent readers never see partial files
+                tmp_path = '%s.%d.tmp' % (paths[k], os.getpid())
+                with open(tmp_path, 'wb') as f:
+                    np.save(f, flow[i].cpu().numpy())
+                os.replace(tmp_path, paths[k])
+
+        return torch.stack(flows, 0)
+
+
+class CachedFlowModel(object):
+    """Runs VFIformer / VFIformerSmall with the flows of a FlowCache.
+
+    Calls without a flow_pre get theirs from the cache, the synthesis runs as usual.
+    Exposes the methods interpolate_video, batch_interpolate and tiled_forward use.
+
+    Args:
+        net: VFIformer or VFIformerSmall with its weights loaded.
+        cache (FlowCache): cache of the flows of net.
+    """
+
+    def __init__(self, net, cache):
+        self.net = get_bare_model(net)
+        self.cache = cache
+
+    def __call__(self, img0, img1, flow_pre=None, feas0=None, feas1=None):
+        if flow_pre is None:
+            flow_pre = self.cache.get_flow(img0, img1)
+        return self.net(img0, img1, flow_pre, feas0=feas0, feas1=feas1)
+
+    def forward_multi(self, img0, img1, timesteps, flow_pre=None, feas0=None, feas1=None):
+        if flow_pre is None:
+            flow_pre = self.cache.get_flow(img0, img1)
+        return self.net.forward_multi(img0, img1, timesteps, flow_pre=flow_pre, feas0=feas0, feas1=feas1)
+
+    def get_flow(self, img0, img1):
+        # the flow of the inputs as given, without the flow_scale of the network, e.g. for
+        # get_flow_scaled in tiled_forward
+        return self.cache.get_flow(img0, img1, flow_scale=1.)
+
+    def get_features(self, img):
+        return self.net.get_features(img)
+
+
+def read_flow_file(path):
+    # .flo (H, W, 2) or .npy (C, H, W) -> (C, H, W) float32
+    if path.endswith('.npy'):
+        flow = np.load(path)
+    else:
+        flow = read_flow(path).transpose(2, 0, 1)
+    return np.ascontiguousarray(flow, dtype=np.float32)
+
+
+def load_flow_files(paths, device, pad_nums=(0, 0, 0, 0)):
+    """Load an external (1, 4, H, W) flow from the midpoint towards img0 and img1.
+
+    Args:
+        paths (list[str]): flows of the unpadded frames, either one 4 channel .npy or
+            the flows towards img0 and towards img1, .npy or .flo, e.g. flo21.npy and
+            flo23.npy of compute_flow_vimeo.py.
+        pad_nums: [pad_t, pad_d, pad_l, pad_r] the inputs were padded with, the padded
+            border gets zero flow.
+    """
+    flow = np.concatenate([read_flow_file(path) for path in paths], 0)
+    assert flow.shape[0] == 4, 'expected 4 flow channels, got %d from %s' % (flow.shape[0], ', '.join(paths))
+    flow = torch.from_numpy(flow).unsqueeze(0).to(device)
+    pad_t, pad_d, pad_l, pad_r = pad_nums
+    return F.pad(flow, (pad_l, pad_r, pad_t, pad_d))
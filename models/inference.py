@@ -0,0 +1,262 @@
+import math
+import cv2
+import numpy as np
+import torch
+import torch.nn as nn
+from torch.nn.parallel import DistributedDataParallel
+from models.archs.VFIformer_arch import get_flow_scaled
+
+
+# rough peak activation memory per input pixel of an fp32 forward pass (measured for
+# VFIformer at 256x256 and 512x512), used to derive tile sizes from a memory budget
+FORWARD_BYTES_PER_PIXEL = 16 * 1024
+FLOW_BYTES_PER_PIXEL = 9 * 1024
+
+
+def get_bare_model(net):
+    if isinstance(net, nn.DataParallel) or isinstance(net, DistributedDataParallel):
+        net = net.module
+    return net
+
+
+def pad_img(img, divisor=64):
+    # pad HR to be mutiple of divisor
+    h, w, c = img.shape
+    if h % divisor != 0 or w % divisor != 0:
+        h_new = math.ceil(h / divisor) * divisor
+        w_new = math.ceil(w / divisor) * divisor
+        pad_t = (h_new - h) // 2
+        pad_d = (h_new - h) // 2 + (h_new - h) % 2
+        pad_l = (w_new - w) // 2
+        pad_r = (w_new - w) // 2 + (w_new - w) % 2
+        img = cv2.copyMakeBorder(img.copy(), pad_t, pad_d, pad_l, pad_r, cv2.BORDER_CONSTANT, value=0)  # cv2.BORDER_REFLECT
+    else:
+        pad_t, pad_d, pad_l, pad_r = 0, 0, 0, 0
+
+    return img, [pad_t, pad_d, pad_l, pad_r]
+
+
+def unpad(output, pad_nums):
+    pad_t, pad_d, pad_l, pad_r = pad_nums
+    if pad_t != 0 or pad_d != 0 or pad_l != 0 or pad_r != 0:
+        h, w = output.size()[-2:]
+        output = output[..., pad_t:h-pad_d, pad_l:w-pad_r]
+    return output
+
+
+def img2tensor(img, device):
+    # (H, W, 3) BGR uint8 -> (1, 3, H, W) float in [0, 1]
+    return torch.from_numpy(img.astype('float32') / 255.).float().permute(2, 0, 1).to(device).unsqueeze(0)
+
+
+def prepare_frame(frame, divisor=64):
+    # reader side of the video pipeline: padded (1, 3, H, W) float CPU tensor and its pad_nums
+    img, pad_nums = pad_img(frame, divisor)
+    return img2tensor(img, 'cpu'), pad_nums
+
+
+def get_timesteps(multi):
+    # timesteps of the frames inserted between two inputs to raise the frame rate by `multi`
+    return [i / multi for i in range(1, multi)]
+
+
+def interpolate_video(net, frames, device, divisor=64, multi=2):
+    """Interpolate the frames between every two consecutive frames of a sequence.
+
+    Every frame is padded, uploaded and encoded by the context network only once:
+    the pyramid features of the last frame are kept and reused as the features of
+    img0 for the next pair.
+
+    Args:
+        net: VFIformer or VFIformerSmall in eval mode.
+        frames: iterable of (H, W, 3) BGR uint8 images, all of the same size, or of the
+            (tensor, pad_nums) of prepare_frame when a reader pool prepares them.
+        device: device to run the network on.
+        divisor (int): inputs are padded to a multiple of it. Default: 64
+        multi (int): frame rate multiplier, multi-1 frames are inserted per pair. Default: 2
+
+    Yields:
+        (idx, outputs): the (1, 3, H, W) frames between frames idx and idx+1, in time order.
+    """
+    net = get_bare_model(net)
+    timesteps = get_timesteps(multi)
+    img0, feas0 = None, None
+    with torch.no_grad():
+        for idx, frame in enumerate(frames):
+            if isinstance(frame, np.ndarray):
+                frame = prepare_frame(frame, divisor)
+            img1, pad_nums = frame
+            img1 = img1.to(device)
+            feas1 = net.get_features(img1)
+
+            if img0 is not None:
+                if multi == 2:
+                    output, _ = net(img0, img1, None, feas0=feas0, feas1=feas1)
+                    outputs = [output]
+                else:
+                    outputs = net.forward_multi(img0, img1, timesteps, feas0=feas0, feas1=feas1)
+                yield idx - 1, [unpad(output, pad_nums) for output in outputs]
+
+            img0, feas0 = img1, feas1
+
+
+def pad_pair(img0, img1, divisor=64):
+    # both frames of a pair are stacked with the other pairs of their bucket, so they must match
+    if img0.shape != img1.shape:
+        raise ValueError('frames of a pair differ in size: %s and %s' % (img0.shape, img1.shape))
+    img0, pad_nums = pad_img(img0, divisor)
+    img1, _ = pad_img(img1, divisor)
+    return img0, img1, pad_nums
+
+
+def stack_frames(imgs, device):
+    # padded (H, W, 3) BGR uint8 images -> (B, 3, H, W) float in [0, 1], uploaded as uint8
+    imgs = torch.from_numpy(np.stack(imgs, 0)).to(device)
+    return imgs.permute(0, 3, 1, 2).float() / 255.
+
+
+def run_bucket(net, bucket, device):
+    # every item of a bucket has the same padded size, so the pairs can be stacked, they are
+    # kept as uint8 images on the host until their batch runs
+    img0 = stack_frames([item[1] for item in bucket], device)
+    img1 = stack_frames([item[2] for item in bucket], device)
+    with torch.no_grad():
+        output, _ = net(img0, img1, None)
+
+    return [(item[0], unpad(output[i:i+1], item[3])) for i, item in enumerate(bucket)]
+
+
+def batch_interpolate(net, pairs, device, batch_size=8, divisor=64):
+    """Interpolate the middle frames of many pairs, batching pairs of the same padded size.
+
+    Pairs are grouped into buckets by their padded resolution. A bucket is stacked and
+    run through the network as soon as it holds batch_size pairs, the remaining buckets
+    are flushed once all pairs are read. Every output is unpadded with the pad_nums of
+    its own pair.
+
+    Args:
+        net: VFIformer or VFIformerSmall in eval mode.
+        pairs: iterable of (img0, img1) BGR uint8 images, sizes may differ between pairs
+            but not within a pair.
+        device: device to run the network on.
+        batch_size (int): maximum number of pairs per forward pass. Default: 8
+        divisor (int): inputs are padded to a multiple of it. Default: 64
+
+    Yields:
+        (idx, output): idx is the position of the pair in `pairs`. Outputs are yielded
+            bucket by bucket, not in input order.
+    """
+    buckets = {}
+    for idx, (img0, img1) in enumerate(pairs):
+        img0, img1, pad_nums = pad_pair(img0, img1, divisor)
+        key = img0.shape[:2]
+        bucket = buckets.setdefault(key, [])
+        bucket.append((idx, img0, img1, pad_nums))
+        if len(bucket) == batch_size:
+            yield from run_bucket(net, buckets.pop(key), device)
+
+    for bucket in buckets.values():
+        yield from run_bucket(net, bucket, device)
+
+
+def pick_tile_size(memory_budget, divisor=64):
+    # largest square tile, multiple of divisor, whose forward pass fits into memory_budget bytes
+    tile_size = int(math.sqrt(memory_budget / FORWARD_BYTES_PER_PIXEL)) // divisor * divisor
+    return max(tile_size, 2 * divisor)
+
+
+def pick_tile_settings(h, w, tile_size=None, memory_budget=None, divisor=64):
+    """Tile size and flow estimation scale of tiled_forward for a (h, w) input.
+
+    Without a memory_budget, a given tile_size bounds the memory like the budget of a
+    forward pass over one tile. The flow scale is the largest of 0.5, 0.25, ... whose
+    flow estimation over the whole frame fits into that budget.
+    """
+    if tile_size is None:
+        tile_size = pick_tile_size(memory_budget, divisor) if memory_budget else max(h, w)
+    else:
+        if tile_size % divisor != 0:
+            raise ValueError('tile_size %d is not a multiple of %d' % (tile_size, divisor))
+        memory_budget = memory_budget or tile_size ** 2 * FORWARD_BYTES_PER_PIXEL
+    down_scale = 0.5
+    if memory_budget:
+        while down_scale > 1 / 16 and h * w * down_scale ** 2 * FLOW_BYTES_PER_PIXEL > memory_budget:
+            down_scale /= 2
+    return tile_size, down_scale
+
+
+def get_flow_downscaled(net, img0, img1, down_scale, divisor=64):
+    # estimate the flow on downscaled inputs and upsample it to the input resolution
+    return get_flow_scaled(get_bare_model(net), img0, img1, down_scale, divisor)
+
+
+def feather_window(length, overlap, at_start, at_end, device):
+    # 1D blending weights of a tile: linear ramps over the overlaps with neighbouring tiles
+    weight = torch.ones(length, device=device)
+    if overlap > 0:
+        ramp = (torch.arange(overlap, device=device).float() + 0.5) / overlap
+        if not at_start:
+            weight[:overlap] = ramp
+        if not at_end:
+            weight[-overlap:] = ramp.flip(0)
+    return weight
+
+
+def tile_starts(size, tile, overlap):
+    if size <= tile:
+        return [0]
+    stride = tile - overlap
+    starts = list(range(0, size - tile, stride))
+    return starts + [size - tile]
+
+
+def tiled_forward(net, img0, img1, tile_size=None, overlap=64, memory_budget=None, down_scale=None, divisor=64, flow=None):
+    """Interpolate a large frame pair tile by tile with bounded peak memory.
+
+    The flow is estimated once on downscaled inputs, each tile then runs the network
+    with its crop of the upsampled flow and the tile outputs are blended with feathered
+    windows over the overlaps, so no seams appear between tiles.
+
+    Args:
+        net: VFIformer or VFIformerSmall in eval mode.
+        img0, img1 (Tensor): (1, 3, H, W) inputs, H and W multiples of divisor.
+        tile_size (int | None): tile side, multiple of divisor. Default: derived from memory_budget
+        overlap (int): overlap between neighbouring tiles. Default: 64
+        memory_budget (int | None): bytes of activation memory a forward pass may use.
+        down_scale (float | None): scale of the flow estimation. Default: the largest of
+            0.5, 0.25, ... whose flow estimation fits into the memory budget, or into the
+            budget of one tile_size tile.
+        flow (Tensor | None): precomputed (1, 4, H, W) flow, skips the flow estimation.
+
+    Returns:
+        Tensor: (1, 3, H, W) interpolated frame.
+    """
+    net = get_bare_model(net)
+    _, _, h, w = img0.size()
+    tile_size, flow_scale = pick_tile_settings(h, w, tile_size, memory_budget, divisor)
+    down_scale = down_scale or flow_scale
+
+    with torch.no_grad():
+        if flow is None:
+            flow = get_flow_downscaled(net, img0, img1, down_scale, divisor)
+        if h <= tile_size and w <= tile_size:
+            output, _ = net(img0, img1, flow_pre=flow)
+            return output
+
+        tile_h = min(tile_size, h)
+        tile_w = min(tile_size, w)
+        overlap = min(overlap, tile_size - divisor)
+        result = torch.zeros((1, 3, h, w), device=img0.device)
+        count = torch.zeros((1, 1, h, w), device=img0.device)
+        for hs in tile_starts(h, tile_h, overlap):
+            for ws in tile_starts(w, tile_w, overlap):
+                crop = (slice(None), slice(None), slice(hs, hs + tile_h), slice(ws, ws + tile_w))
+                output, _ = net(img0[crop], img1[crop], flow_pre=flow[crop])
+
+                weight_h = feather_window(tile_h, overlap, hs == 0, hs + tile_h == h, img0.device)
+                weight_w = feather_window(tile_w, overlap, ws == 0, ws + tile_w == w, img0.device)
+                weight = (weight_h[:, None] * weight_w[None, :])[None, None]
+                result[crop] += output * weight
+                count[crop] += weight
+
+    return result / count
@@ -7,6 +7,7 @@ from torch.nn import functional as F
 import sys
 sys.path.append('..')
 from models.vgg_model import VGGFeatureExtractor
+from models.archs.VFIformer_arch import autocast, make_grad_scaler
 
 _reduction_modes = ['none', 'mean', 'sum']
 
@@ -497,7 +498,7 @@ class VGGStyleDiscriminator160(nn.Module):
 ## relative gan
 class AdversarialLoss(nn.Module):
     def __init__(self, use_cpu=False, gpu_ids=[], dist=False, gan_type='RGAN', gan_k=2,
-                 lr_dis=1e-4, train_crop_size=40):
+                 lr_dis=1e-4, train_crop_size=40, precision='fp32'):
 
         super(AdversarialLoss, self).__init__()
         self.gan_type = gan_type
@@ -515,6 +516,9 @@ class AdversarialLoss(nn.Module):
             )
 
         self.criterion_adv = GANLoss(gan_type='vanilla').to(self.device)
+        # the discriminator has its own optimizer, so its own scaler for fp16 training
+        self.precision = precision
+        self.scaler = make_grad_scaler(precision, self.device)
 
     def set_requires_grad(self, nets, requires_grad=False):
         """Set requies_grad=Fasle for all the networks to avoid unnecessary computations
@@ -529,34 +533,47 @@ class AdversarialLoss(nn.Module):
                 for param in net.parameters():
                     param.requires_grad = requires_grad
 
+    def backward(self, loss):
+        if self.scaler is None:
+            loss.backward()
+        else:
+            self.scaler.scale(loss).backward()
+
     def forward(self, fake, real):
 
         # D Loss
         for _ in range(self.gan_k):
             self.set_requires_grad(self.discriminator, True)
             self.optimizer.zero_grad()
-            # real
-            d_fake = self.discriminator(fake).detach()
-            d_real = self.discriminator(real)
-            d_real_loss = self.criterion_adv(d_real - torch.mean(d_fake), True,
-                                               is_disc=True) * 0.5
-            d_real_loss.backward()
+            # real, the losses are computed under autocast, backward and step run outside of it
+            with autocast(real, self.precision):
+                d_fake = self.discriminator(fake).detach()
+                d_real = self.discriminator(real)
+                d_real_loss = self.criterion_adv(d_real - torch.mean(d_fake), True,
+                                                   is_disc=True) * 0.5
+            self.backward(d_real_loss)
             # fake
-            d_fake = self.discriminator(fake.detach())
-            d_fake_loss = self.criterion_adv(d_fake - torch.mean(d_real.detach()), False,
-                                                is_disc=True) * 0.5
-            d_fake_loss.backward()
+            with autocast(real, self.precision):
+                d_fake = self.discriminator(fake.detach())
+                d_fake_loss = self.criterion_adv(d_fake - torch.mean(d_real.detach()), False,
+                                                    is_disc=True) * 0.5
+            self.backward(d_fake_loss)
             loss_d = d_real_loss + d_fake_loss
             
-            self.optimizer.step()
+            if self.scaler is None:
+                self.optimizer.step()
+            else:
+                self.scaler.step(self.optimizer)
+                self.scaler.update()
 
         # G Loss
         self.set_requires_grad(self.discriminator, False)
-        d_real = self.discriminator(real).detach()
-        d_fake = self.discriminator(fake)
-        g_real_loss = self.criterion_adv(d_real - torch.mean(d_fake), False, is_disc=False) * 0.5
-        g_fake_loss = self.criterion_adv(d_fake - torch.mean(d_real), True, is_disc=False) * 0.5
-        loss_g = g_real_loss + g_fake_loss
+        with autocast(real, self.precision):
+            d_real = self.discriminator(real).detach()
+            d_fake = self.discriminator(fake)
+            g_real_loss = self.criterion_adv(d_real - torch.mean(d_fake), False, is_disc=False) * 0.5
+            g_fake_loss = self.criterion_adv(d_fake - torch.mean(d_real), True, is_disc=False) * 0.5
+            loss_g = g_real_loss + g_fake_loss
 
         # Generator loss
         return loss_g, loss_d
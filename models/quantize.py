@@ -0,0 +1,99 @@
+import io
+import logging
+import torch
+import torch.nn as nn
+from torch.ao.quantization import QuantStub, DeQuantStub, QConfig, default_weight_observer, get_default_qconfig, \
+    prepare, convert, quantize_dynamic
+from models.inference import get_bare_model
+from models.archs.VFIformer_arch import IFBlock, Conv2
+
+
+# 'dynamic': int8 weights for the linear layers of the transformer, activations are
+# quantized on the fly. 'static': additionally int8 convolutions for the IFNet blocks and
+# the context encoders, with activation ranges calibrated on sample pairs. CPU only.
+QUANT_MODES = ('none', 'dynamic', 'static')
+
+
+class QuantizedBlock(nn.Module):
+    """Runs a float block between a quantize and a dequantize step.
+
+    Only the wrapped block is converted to int8 by the static quantization, everything
+    around it (warps, residual adds, the flow heads) stays in fp32.
+    """
+
+    def __init__(self, block):
+        super(QuantizedBlock, self).__init__()
+        self.quant = QuantStub()
+        self.block = block
+        self.dequant = DeQuantStub()
+
+    def forward(self, x):
+        return self.dequant(self.block(self.quant(x)))
+
+
+def wrap_conv_blocks(net):
+    # the conv stacks of the IFNet blocks and the feature pyramid carry most of the conv FLOPs.
+    # conv0 of the IFNet blocks stays in fp32, its input mixes images and flows of very different
+    # ranges and an int8 version of it shifts the estimated flow by up to a pixel
+    blocks = []
+    for module in list(net.modules()):
+        if isinstance(module, IFBlock):
+            module.convblock = QuantizedBlock(module.convblock)
+            blocks.append(module.convblock)
+        else:
+            for name, child in list(module.named_children()):
+                if isinstance(child, Conv2):
+                    setattr(module, name, QuantizedBlock(child))
+                    blocks.append(getattr(module, name))
+
+    return blocks
+
+
+def quantize_G(net, mode='dynamic', calib_pairs=None, backend='x86'):
+    """Quantize VFIformer / VFIformerSmall with loaded weights for CPU inference.
+
+    Args:
+        net: the fp32 network, its weights are replaced in place.
+        mode (str): 'none' | 'dynamic' | 'static'. Default: 'dynamic'
+        calib_pairs: iterable of (img0, img1) CPU tensors, needed by 'static' to
+            calibrate the activation ranges of the conv blocks.
+        backend (str): quantized engine, 'x86' | 'fbgemm' | 'qnnpack'. Default: 'x86'
+
+    Returns:
+        The quantized network.
+    """
+    assert mode in QUANT_MODES, 'unknown quantization mode: %s' % mode
+    net = get_bare_model(net)
+    if mode == 'none':
+        return net
+    assert getattr(net, 'precision', 'fp32') == 'fp32', 'quantized models run with --precision fp32'
+    torch.backends.quantized.engine = backend
+    net.eval()
+
+    if mode == 'static':
+        assert calib_pairs is not None, 'static quantization needs calibration pairs'
+        qconfig = get_default_qconfig(backend)
+        for block in wrap_conv_blocks(net):
+            block.qconfig = qconfig
+            for module in block.modules():
+                if isinstance(module, nn.PReLU):
+                    # per channel observers need a weight with an output channel dim
+                    module.qconfig = QConfig(activation=qconfig.activation, weight=default_weight_observer)
+        prepare(net, inplace=True)
+        num = 0
+        with torch.no_grad():
+            for img0, img1 in calib_pairs:
+                net(img0, img1, None)
+                num += 1
+        logging.info('calibrated the conv blocks on %d pairs' % num)
+        convert(net, inplace=True)
+
+    quantize_dynamic(net.transformer, {nn.Linear}, dtype=torch.qint8, inplace=True)
+    return net
+
+
+def get_model_size(net):
+    # bytes of the serialized state dict, counts the packed int8 weights of quantized layers
+    buffer = io.BytesIO()
+    torch.save(get_bare_model(net).state_dict(), buffer)
+    return buffer.tell()
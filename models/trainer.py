@@ -11,11 +11,9 @@ from tensorboardX import SummaryWriter
 import torch
 import torch.nn as nn
 from torch.nn.parallel import DistributedDataParallel
-from torch.autograd import Variable
 from torch.optim.lr_scheduler import CosineAnnealingLR, CyclicLR
 import torchvision
 import torch.nn.functional as F
-from torch.utils.data import Dataset, DataLoader
 from collections import OrderedDict
 import importlib
 import sys
@@ -24,8 +22,10 @@ from utils import util, calculate_PSNR_SSIM
 from utils.flowlib import save_flow_image
 from utils.pytorch_msssim import ssim_matlab
 from models.modules import define_G
+from models.archs.VFIformer_arch import autocast, make_grad_scaler
 from models.losses import PerceptualLoss, AdversarialLoss, EPE, Ternary
-from dataloader import DistIterSampler, create_dataloader
+from models.flow_cache import FlowCache
+from dataloader import DistIterSampler, DevicePrefetcher, create_dataloader
 
 
 class Trainer(object):
@@ -33,6 +33,7 @@ class Trainer(object):
         super(Trainer, self).__init__()
         self.args = args
         self.augmentation = args.data_augmentation
+        self.precision = getattr(args, 'precision', 'fp32')
         self.device = torch.device('cuda' if len(args.gpu_ids) != 0 else 'cpu')
         args.device = self.device
 
@@ -46,14 +47,15 @@ class Trainer(object):
                 train_sampler = DistIterSampler(self.train_dataset, args.world_size, args.rank, dataset_ratio)
                 self.train_dataloader = create_dataloader(self.train_dataset, args, train_sampler)
             else:
-                self.train_dataloader = DataLoader(self.train_dataset, batch_size=args.batch_size, num_workers=args.num_workers, shuffle=True)
+                self.train_dataloader = create_dataloader(self.train_dataset, args)
+            self.train_prefetcher = DevicePrefetcher(self.train_dataloader, self.device)
 
             self.args.step_per_epoch = self.train_dataloader.__len__()
 
         else:
             testset_ = getattr(importlib.import_module('dataloader.dataset'), args.testset, None)
             self.test_dataset = testset_(self.args)
-            self.test_dataloader = DataLoader(self.test_dataset, batch_size=1, num_workers=args.num_workers, shuffle=False)
+            self.test_dataloader = create_dataloader(self.test_dataset, args)
 
         ## init network
         self.net = define_G(args)
@@ -72,6 +74,9 @@ class Trainer(object):
             # self.optimizer_G = torch.optim.Adam(itertools.chain.from_iterable(g_params), lr=args.lr, weight_decay=args.weight_decay)
             # self.scheduler = CosineAnnealingLR(self.optimizer_G, T_max=500)  # T_max=args.max_iter
             self.optimizer_G = torch.optim.AdamW(itertools.chain.from_iterable(g_params), lr=args.lr, weight_decay=args.weight_decay)
+            self.scaler = make_grad_scaler(self.precision, self.device)
+            if args.rank <= 0 and self.precision != 'fp32':
+                logging.info('  mixed precision training in %s...' % self.precision)
 
 
             if args.loss_l1:
@@ -95,7 +100,8 @@ class Trainer(object):
 
             if args.loss_adv:
                 self.criterion_adv = AdversarialLoss(gpu_ids=args.gpu_ids, dist=args.dist, gan_type=args.gan_type,
-                                                             gan_k=1, lr_dis=args.lr_D, train_crop_size=40)
+                                                             gan_k=1, lr_dis=args.lr_D, train_crop_size=40,
+                                                             precision=self.precision)
                 self.lambda_adv = args.lambda_adv
                 if args.rank <= 0:
                     logging.info('  using adv loss...')
@@ -139,11 +145,67 @@ class Trainer(object):
                 for param in net.parameters():
                     param.requires_grad = requires_grad
 
-    def prepare(self, batch_samples):
+    def prepare(self, batch_samples, augment=False):
         for key in batch_samples.keys():
             if 'folder' not in key and 'pad_nums' not in key:
-                batch_samples[key] = Variable(batch_samples[key].to(self.device), requires_grad=False)
+                if isinstance(batch_samples[key], list):
+                    batch_samples[key] = [v.to(self.device) for v in batch_samples[key]]
+                else:
+                    batch_samples[key] = batch_samples[key].to(self.device)
+
+        if augment:
+            batch_samples = self.augment(batch_samples)
+
+        return batch_samples
 
+    def normalize(self, img):
+        # uint8 frames of the training sets are scaled to [0, 1] on the device
+        if img.dtype == torch.uint8:
+            return img.float() / 255.
+        return img
+
+    def augment(self, batch_samples):
+        """Normalize and augment a training batch on the device.
+
+        Every sample draws its own vertical flip, horizontal flip and time reversal. With
+        --data_augmentation, square crops are also rotated by 90 degrees and the color
+        channels reversed. The flow_gt channels, (x, y) towards img0 then towards img1,
+        are moved and negated along with the frames.
+        """
+        img0 = self.normalize(batch_samples['img0'])
+        gt = self.normalize(batch_samples['gt'])
+        img1 = self.normalize(batch_samples['img1'])
+        flow_gt = batch_samples['flow_gt'].float()
+        b, _, h, w = img0.size()
+
+        def draw():
+            return (torch.rand(b, device=img0.device) < 0.5).view(b, 1, 1, 1)
+
+        if self.augmentation and h == w:
+            mask = draw()  # rotate
+            img0, gt, img1 = [torch.where(mask, torch.rot90(x, 1, (2, 3)), x) for x in (img0, gt, img1)]
+            flow_rot = torch.rot90(flow_gt, 1, (2, 3))
+            flow_rot = torch.stack((flow_rot[:, 1], -flow_rot[:, 0], flow_rot[:, 3], -flow_rot[:, 2]), 1)
+            flow_gt = torch.where(mask, flow_rot, flow_gt)
+
+            mask = draw()  # color aug
+            img0, gt, img1 = [torch.where(mask, x.flip(1), x) for x in (img0, gt, img1)]
+
+        sign = flow_gt.new_tensor([1., -1., 1., -1.]).view(1, 4, 1, 1)
+        mask = draw()  # vertical flip
+        img0, gt, img1 = [torch.where(mask, x.flip(2), x) for x in (img0, gt, img1)]
+        flow_gt = torch.where(mask, flow_gt.flip(2) * sign, flow_gt)
+
+        sign = flow_gt.new_tensor([-1., 1., -1., 1.]).view(1, 4, 1, 1)
+        mask = draw()  # horizontal flip
+        img0, gt, img1 = [torch.where(mask, x.flip(3), x) for x in (img0, gt, img1)]
+        flow_gt = torch.where(mask, flow_gt.flip(3) * sign, flow_gt)
+
+        mask = draw()  # reverse time
+        img0, img1 = torch.where(mask, img1, img0), torch.where(mask, img0, img1)
+        flow_gt = torch.where(mask, torch.cat((flow_gt[:, 2:4], flow_gt[:, 0:2]), 1), flow_gt)
+
+        batch_samples.update({'img0': img0, 'gt': gt, 'img1': img1, 'flow_gt': flow_gt})
         return batch_samples
 
     def train(self):
@@ -171,7 +233,9 @@ class Trainer(object):
             # logging.info('current_lr: %f' % (self.optimizer_G.param_groups[0]['lr']))
 
             t0 = time.time()
-            for j, batch_samples in enumerate(self.train_dataloader):
+            data_time = 0
+            for j, batch_samples in enumerate(self.train_prefetcher):
+                data_time += self.train_prefetcher.wait_time
                 log_info = 'epoch:%03d step:%04d  ' % (i, j)
 
                 # set learning rate
@@ -181,17 +245,21 @@ class Trainer(object):
                 log_info += 'current_lr: %f  ' % (self.optimizer_G.param_groups[0]['lr'])
 
                 ## prepare data
-                batch_samples = self.prepare(batch_samples)
+                batch_samples = self.prepare(batch_samples, augment=True)
                 img0 = batch_samples['img0']
                 img1 = batch_samples['img1']
                 gt = batch_samples['gt']
                 flow_gt = batch_samples['flow_gt']
 
                 ## forward
-                if not self.args.loss_l1:
-                    _, flow_list = self.net(torch.cat([img0, img1], 1))
-                else:
-                    output, flow_list = self.net(img0, img1, None)
+                with autocast(img0, self.precision):
+                    if not self.args.loss_l1:
+                        _, flow_list = self.net(torch.cat([img0, img1], 1))
+                    else:
+                        output, flow_list = self.net(img0, img1, None)
+                if self.args.loss_l1:
+                    # the reconstruction and flow losses are computed in fp32
+                    output = output.float()
 
                 ## optimization
                 loss = 0
@@ -223,29 +291,40 @@ class Trainer(object):
 
 
                 if self.args.loss_perceptual:
-                    perceptual_loss, _ = self.criterion_perceptual(output, gt)
+                    with autocast(output, self.precision):
+                        perceptual_loss, _ = self.criterion_perceptual(output, gt)
+                    perceptual_loss = perceptual_loss.float()
                     perceptual_loss = perceptual_loss * self.lambda_perceptual
                     loss += perceptual_loss
                     log_info += 'perceptual_loss:%.06f ' % (perceptual_loss.item())
 
                 if self.args.loss_adv:
+                    # runs its own autocast, the discriminator steps outside of it
                     adv_loss, d_loss = self.criterion_adv(output, gt)
+                    adv_loss = adv_loss.float()
                     adv_loss = adv_loss * self.lambda_adv
                     loss += adv_loss
                     log_info += 'adv_loss:%.06f ' % (adv_loss.item())
                     log_info += 'd_loss:%.06f ' % (d_loss.item())
 
                 log_info += 'loss_sum:%f ' % (loss.item())
-                loss.backward()
-                self.optimizer_G.step()
+                if self.scaler is None:
+                    loss.backward()
+                    self.optimizer_G.step()
+                else:
+                    self.scaler.scale(loss).backward()
+                    self.scaler.step(self.optimizer_G)
+                    self.scaler.update()
 
                 ## print information
                 if j % self.args.log_freq == 0:
                     t1 = time.time()
-                    log_info += '%4.6fs/batch' % ((t1-t0)/self.args.log_freq)
+                    log_info += '%4.6fs/batch ' % ((t1-t0)/self.args.log_freq)
+                    log_info += 'data:%4.6fs/batch' % (data_time/self.args.log_freq)
                     if self.args.rank <= 0:
                         logging.info(log_info)
                     t0 = time.time()
+                    data_time = 0
 
                 ## visualization
                 if j % self.args.vis_freq == 0:
@@ -294,6 +373,8 @@ class Trainer(object):
             os.mkdir(save_path)
 
         self.net.eval()
+        # created here, after test.py may have quantized the network
+        flow_cache = FlowCache(self.args.flow_cache, self.net) if getattr(self.args, 'flow_cache', '') else None
         logging.info('start testing...')
         logging.info('%d testing samples' % (self.test_dataset.__len__()))
         num = 0
@@ -308,53 +389,59 @@ class Trainer(object):
                 batch_samples = self.prepare(batch_samples)
                 img0 = batch_samples['img0']
                 img1 = batch_samples['img1']
-                gt = batch_samples['gt']
-                folder = batch_samples['folder'][0]
-                pad_nums = batch_samples['pad_nums']
-                pad_t, pad_d, pad_l, pad_r = pad_nums
-
-                # inference
-                output, flow = self.net(img0, img1, None)
-                if pad_t != 0 or pad_d != 0 or pad_l != 0 or pad_r != 0:
-                    _, _, h, w = output.size()
-                    output = output[:, :, pad_t:h-pad_d, pad_l:w-pad_r]
-
-                # calc psnr and ssim
-                ssim = ssim_matlab(gt / 255., torch.round(output[0] * 255).unsqueeze(0) / 255.).detach().cpu().numpy()
-                mid = np.round((output[0] * 255).detach().cpu().numpy()).astype('uint8').transpose(1, 2, 0) / 255.
-                I1 = (gt[0]).detach().cpu().numpy().astype('uint8').transpose(1, 2, 0) / 255.
-                psnr = -10 * math.log10(((I1 - mid) * (I1 - mid)).mean())
-
-                PSNR.append(psnr)
-                SSIM.append(ssim)
-                logging.info('testing on: %s    psnr: %.6f    ssim: %.6f' % (folder, psnr, ssim))
-
-                if self.args.testset == 'MiddleburyDataset':
-                    out = np.round(output[0].detach().cpu().numpy().transpose(1, 2, 0) * 255)
-                    IE = np.abs((out - (gt[0]).detach().cpu().numpy().astype('uint8').transpose(1, 2, 0) * 1.0)).mean()
-                    IE_list.append(IE)
-                    logging.info('IE: %.6f' % (IE))
-
-                if self.args.save_result:
-                    path = os.path.join(save_path, folder)
-                    if not os.path.exists(path):
-                        os.makedirs(path)
-                    imt = output[0].flip(dims=(0,)).clamp(0., 1.)
-                    im0 = img0[0].flip(dims=(0,)).clamp(0., 1.)
-                    im1 = img1[0].flip(dims=(0,)).clamp(0., 1.)
-                    torchvision.utils.save_image(imt, os.path.join(path, 'imt.png'))
-                    torchvision.utils.save_image(im0, os.path.join(path, 'im0.png'))
-                    torchvision.utils.save_image(im1, os.path.join(path, 'im1.png'))
-
-
-                    # flow = flow[0].permute(1, 2, 0).detach().cpu().numpy()
-                    # flow_gt = flow_gt[0].permute(1, 2, 0).detach().cpu().numpy()
-                    # save_flow_image(flow[:, :, :2], os.path.join(path, 'flow0.png'))
-                    # save_flow_image(flow[:, :, 2:], os.path.join(path, 'flow1.png'))
-                    # save_flow_image(flow_gt[:, :, :2], os.path.join(path, 'flow0_gt.png'))
-                    # save_flow_image(flow_gt[:, :, 2:], os.path.join(path, 'flow1_gt.png'))
-
-                num += 1
+
+                # inference, a batch only holds samples of the same padded size
+                flow_pre = None
+                if getattr(self.args, 'dataset_flow', False):
+                    if 'flow_gt' not in batch_samples:
+                        raise ValueError('--dataset_flow needs a test set that loads flows, %s does not' % self.args.testset)
+                    flow_pre = batch_samples['flow_gt']
+                elif flow_cache is not None:
+                    flow_pre = flow_cache.get_flow(img0, img1)
+                outputs, flow = self.net(img0, img1, flow_pre)
+
+                for k in range(outputs.size(0)):
+                    output = outputs[k:k+1]
+                    gt = batch_samples['gt'][k].unsqueeze(0)
+                    folder = batch_samples['folder'][k]
+                    pad_t, pad_d, pad_l, pad_r = batch_samples['pad_nums'][k]
+                    if pad_t != 0 or pad_d != 0 or pad_l != 0 or pad_r != 0:
+                        _, _, h, w = output.size()
+                        output = output[:, :, pad_t:h-pad_d, pad_l:w-pad_r]
+
+                    # calc psnr and ssim
+                    psnr, ssim = self.calc_metrics(output, gt)
+
+                    PSNR.append(psnr)
+                    SSIM.append(ssim)
+                    logging.info('testing on: %s    psnr: %.6f    ssim: %.6f' % (folder, psnr, ssim))
+
+                    if self.args.testset == 'MiddleburyDataset':
+                        out = np.round(output[0].detach().cpu().numpy().transpose(1, 2, 0) * 255)
+                        IE = np.abs((out - (gt[0]).detach().cpu().numpy().astype('uint8').transpose(1, 2, 0) * 1.0)).mean()
+                        IE_list.append(IE)
+                        logging.info('IE: %.6f' % (IE))
+
+                    if self.args.save_result:
+                        path = os.path.join(save_path, folder)
+                        if not os.path.exists(path):
+                            os.makedirs(path)
+                        imt = output[0].flip(dims=(0,)).clamp(0., 1.)
+                        im0 = img0[k].flip(dims=(0,)).clamp(0., 1.)
+                        im1 = img1[k].flip(dims=(0,)).clamp(0., 1.)
+                        torchvision.utils.save_image(imt, os.path.join(path, 'imt.png'))
+                        torchvision.utils.save_image(im0, os.path.join(path, 'im0.png'))
+                        torchvision.utils.save_image(im1, os.path.join(path, 'im1.png'))
+
+
+                        # flow = flow[0].permute(1, 2, 0).detach().cpu().numpy()
+                        # flow_gt = flow_gt[0].permute(1, 2, 0).detach().cpu().numpy()
+                        # save_flow_image(flow[:, :, :2], os.path.join(path, 'flow0.png'))
+                        # save_flow_image(flow[:, :, 2:], os.path.join(path, 'flow1.png'))
+                        # save_flow_image(flow_gt[:, :, :2], os.path.join(path, 'flow0_gt.png'))
+                        # save_flow_image(flow_gt[:, :, 2:], os.path.join(path, 'flow1_gt.png'))
+
+                    num += 1
 
 
         PSNR = np.mean(PSNR)
@@ -362,7 +449,18 @@ class Trainer(object):
         logging.info('--------- average PSNR: %.06f,  SSIM: %.06f' % (PSNR, SSIM))
         if self.args.testset == 'MiddleburyDataset':
             logging.info('--------- average IE: %.06f' % (np.mean(IE_list)))
+        if flow_cache is not None:
+            logging.info('--------- flow cache: %d hits, %d misses' % (flow_cache.hits, flow_cache.misses))
+
+
+    def calc_metrics(self, output, gt):
+        # output: (1, 3, H, W) in [0, 1], gt: (1, 3, H, W) in [0, 255]
+        ssim = ssim_matlab(gt / 255., torch.round(output[0] * 255).unsqueeze(0) / 255.).detach().cpu().numpy()
+        mid = np.round((output[0] * 255).detach().cpu().numpy()).astype('uint8').transpose(1, 2, 0) / 255.
+        I1 = (gt[0]).detach().cpu().numpy().astype('uint8').transpose(1, 2, 0) / 255.
+        psnr = -10 * math.log10(((I1 - mid) * (I1 - mid)).mean())
 
+        return psnr, ssim
 
     def save_image(self, tensor, path):
         img = Image.fromarray(((tensor/2.0 + 0.5).data.cpu().numpy()*255).transpose((1, 2, 0)).astype(np.uint8))
@@ -0,0 +1,80 @@
+import os
+import time
+import logging
+import argparse
+import numpy as np
+
+from utils.util import print_args
+from utils.pipeline import ordered_map
+from dataloader.dataset import VimeoDataset, get_packed_layout
+
+
+
+def pack(dataset, save_root, shard_size, num_workers=4):
+    """Write the triplets and flows of a VimeoDataset into shards for VimeoPackedDataset.
+
+    Args:
+        dataset (VimeoDataset): lists the triplets and flows of a phase.
+        save_root (str): folder of the shards and of index.npz.
+        shard_size (int): bytes after which the next shard is started.
+        num_workers (int): threads decoding the pngs and flows. Default: 4
+    """
+    os.makedirs(save_root, exist_ok=True)
+    names, shards, offsets, sizes = [], [], [], []
+    shard_id, offset, f = 0, 0, None
+    start = time.time()
+
+    samples = ordered_map(dataset.getimg, range(len(dataset)), num_workers, max_pending=4 * max(num_workers, 1))
+    for i, (img0, gt, img1, flow_gt, folder) in enumerate(samples):
+        h, w, _ = img0.shape
+        if f is None or offset >= shard_size:
+            if f is not None:
+                f.close()
+                shard_id += 1
+            f = open(os.path.join(save_root, 'shard_%03d.bin' % shard_id), 'wb')
+            offset = 0
+
+        flow_offset, end = get_packed_layout(offset, h, w)
+        frames = np.stack([img0, gt, img1], 0).astype(np.uint8)
+        f.write(frames.tobytes())
+        f.write(bytes(flow_offset - offset - frames.nbytes))
+        flow = np.ascontiguousarray(flow_gt, dtype=np.float16)
+        f.write(flow.tobytes())
+        f.write(bytes(end - flow_offset - flow.nbytes))
+
+        names.append(folder)
+        shards.append(shard_id)
+        offsets.append(offset)
+        sizes.append((h, w))
+        offset = end
+        if (i + 1) % 1000 == 0:
+            logging.info('%d / %d triplets packed, %.1fs' % (i + 1, len(dataset), time.time() - start))
+    if f is not None:
+        f.close()
+
+    # the index is written last, an interrupted run leaves no usable pack behind
+    tmp_path = os.path.join(save_root, 'index.tmp.npz')
+    np.savez(tmp_path, names=np.array(names), shards=np.array(shards, dtype=np.int32),
+             offsets=np.array(offsets, dtype=np.int64), sizes=np.array(sizes, dtype=np.int32).reshape(-1, 2))
+    os.replace(tmp_path, os.path.join(save_root, 'index.npz'))
+    logging.info('packed %d triplets into %d shards in %.1fs: %s' % (len(names), shard_id + 1, time.time() - start, save_root))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='pack the Vimeo90K triplets and flows into memory-mapped shards')
+    parser.add_argument('--phase', default='train', type=str, help='train|test, packs tri_trainlist.txt or tri_testlist.txt')
+    parser.add_argument('--data_root', default='/home/sharedir/videos/vimeo_triplet/', type=str)
+    parser.add_argument('--crop_size', default=192, type=int)
+    parser.add_argument('--shard_size', default=4, type=float, help='GB per shard file')
+    parser.add_argument('--num_workers', default=4, type=int, help='threads decoding the pngs and flows')
+
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s [%(levelname)s] %(message)s')
+    print_args(args)
+
+    dataset = VimeoDataset(args)
+    pack(dataset, os.path.join(args.data_root, 'packed', args.phase), int(args.shard_size * 1024 ** 3), args.num_workers)
+
+
+if __name__ == '__main__':
+    main()
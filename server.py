@@ -0,0 +1,235 @@
+import time
+import json
+import logging
+import argparse
+import threading
+from collections import OrderedDict
+from email.parser import BytesParser
+from email.policy import HTTP
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import cv2
+import numpy as np
+import torch
+import torch.nn as nn
+from torch.nn.parallel import DistributedDataParallel
+
+from utils.util import print_args
+from models.modules import define_G
+from models.inference import pad_pair, run_bucket
+from models.flow_cache import FlowCache, CachedFlowModel
+
+
+
+def load_networks(network, resume):
+    if isinstance(network, nn.DataParallel) or isinstance(network, DistributedDataParallel):
+        network = network.module
+    load_net = torch.load(resume, map_location=torch.device('cpu'))
+    load_net_clean = OrderedDict()  # remove unnecessary 'module.'
+    for k, v in load_net.items():
+        if k.startswith('module.'):
+            load_net_clean[k[7:]] = v
+        else:
+            load_net_clean[k] = v
+    network.load_state_dict(load_net_clean)
+
+    return network
+
+
+class Request(object):
+    # one pair waiting for its batch, the handler thread blocks on `done`
+    def __init__(self, img0, img1, divisor):
+        self.img0, self.img1, self.pad_nums = pad_pair(img0, img1, divisor)
+        self.key = self.img0.shape[:2]
+        self.time = time.time()
+        self.done = threading.Event()
+        self.output = None
+        self.error = None
+
+
+class BatchQueue(object):
+    """Coalesces concurrent pair requests into batches by padded resolution.
+
+    A single worker thread runs the network. A batch starts with the oldest pending
+    request and takes the pending requests of the same padded size, up to batch_size.
+    It waits at most max_wait seconds after the arrival of its oldest request for
+    more of them, so a lone request is delayed by max_wait at most.
+
+    Args:
+        net: VFIformer or VFIformerSmall in eval mode.
+        device: device to run the network on.
+        batch_size (int): maximum number of pairs per forward pass. Default: 8
+        max_wait (float): seconds a batch waits for more requests. Default: 0.01
+        divisor (int): inputs are padded to a multiple of it. Default: 64
+    """
+
+    def __init__(self, net, device, batch_size=8, max_wait=0.01, divisor=64):
+        self.net = net
+        self.device = device
+        self.batch_size = batch_size
+        self.max_wait = max_wait
+        self.divisor = divisor
+        self.pending = []
+        self.cond = threading.Condition()
+        self.num_batches = 0
+        self.num_pairs = 0
+        self.worker = threading.Thread(target=self.run, daemon=True)
+        self.worker.start()
+
+    def submit(self, img0, img1):
+        """Interpolate one pair of (H, W, 3) BGR uint8 images, blocks until its batch ran."""
+        request = Request(img0, img1, self.divisor)
+        with self.cond:
+            self.pending.append(request)
+            self.cond.notify()
+        request.done.wait()
+        if request.error is not None:
+            raise request.error
+        return request.output
+
+    def next_batch(self):
+        with self.cond:
+            while not self.pending:
+                self.cond.wait()
+            key = self.pending[0].key
+            deadline = self.pending[0].time + self.max_wait
+            while True:
+                batch = [request for request in self.pending if request.key == key][:self.batch_size]
+                remaining = deadline - time.time()
+                if len(batch) == self.batch_size or remaining <= 0:
+                    break
+                self.cond.wait(remaining)
+            self.pending = [request for request in self.pending if request not in batch]
+        return batch
+
+    def run(self):
+        while True:
+            batch = self.next_batch()
+            try:
+                bucket = [(i, request.img0, request.img1, request.pad_nums) for i, request in enumerate(batch)]
+                for i, output in run_bucket(self.net, bucket, self.device):
+                    output = output[0].clamp(0., 1.).mul(255.).round().byte()
+                    batch[i].output = output.permute(1, 2, 0).cpu().numpy()
+            except Exception as e:
+                logging.exception('batch of %d pairs failed' % len(batch))
+                for request in batch:
+                    request.error = e
+            self.num_batches += 1
+            self.num_pairs += len(batch)
+            for request in batch:
+                request.done.set()
+
+
+def parse_form(content_type, body):
+    # multipart/form-data fields of a request, e.g. from `curl -F img0=@a.png -F img1=@b.png`
+    message = BytesParser(policy=HTTP).parsebytes(b'Content-Type: ' + content_type.encode() + b'\r\n\r\n' + body)
+    if not message.is_multipart():
+        return {}
+    return {part.get_param('name', header='content-disposition'): part.get_payload(decode=True)
+            for part in message.iter_parts()}
+
+
+def make_handler(queue):
+    class Handler(BaseHTTPRequestHandler):
+        def send(self, code, body, content_type):
+            self.send_response(code)
+            self.send_header('Content-Type', content_type)
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def send_json(self, code, obj):
+            self.send(code, json.dumps(obj).encode(), 'application/json')
+
+        def do_GET(self):
+            if self.path != '/health':
+                return self.send_json(404, {'error': 'unknown path %s' % self.path})
+            self.send_json(200, {'batches': queue.num_batches, 'pairs': queue.num_pairs,
+                                 'pending': len(queue.pending)})
+
+        def do_POST(self):
+            # POST /interpolate with the form fields img0 and img1 (encoded images), answers
+            # with the middle frame as png
+            if self.path != '/interpolate':
+                return self.send_json(404, {'error': 'unknown path %s' % self.path})
+            body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+            fields = parse_form(self.headers.get('Content-Type', ''), body)
+            imgs = [cv2.imdecode(np.frombuffer(fields[name], np.uint8), cv2.IMREAD_COLOR)
+                    if fields.get(name) else None for name in ('img0', 'img1')]
+            if imgs[0] is None or imgs[1] is None:
+                return self.send_json(400, {'error': 'expected the images img0 and img1 as multipart form fields'})
+            if imgs[0].shape != imgs[1].shape:
+                return self.send_json(400, {'error': 'img0 and img1 differ in size'})
+
+            start = time.time()
+            try:
+                output = queue.submit(imgs[0], imgs[1])
+            except Exception as e:
+                return self.send_json(500, {'error': str(e)})
+            logging.info('%dx%d pair in %.3fs' % (imgs[0].shape[0], imgs[0].shape[1], time.time() - start))
+            self.send(200, cv2.imencode('.png', output)[1].tobytes(), 'image/png')
+
+        def log_message(self, format, *args):
+            pass
+
+    return Handler
+
+
+def main():
+    parser = argparse.ArgumentParser(description='serve frame interpolation over http with a warm model')
+    parser.add_argument('--phase', default='test', type=str)
+
+    ## device setting
+    parser.add_argument('--gpu_ids', type=str, default='0', help='gpu ids: e.g. 0  0,1,2, 0,2. use -1 for CPU')
+
+    ## network setting
+    parser.add_argument('--net_name', default='VFIformer', type=str, help='')
+    parser.add_argument('--attn_backend', default='math', type=str, help='math|sdpa, sdpa uses F.scaled_dot_product_attention')
+    parser.add_argument('--refine_levels', default=4, type=int, help='VFIformer only: flow pyramid levels refined, 0-4, fewer is faster')
+    parser.add_argument('--refine_iters', default=0, type=int, help='VFIformer only: refinement iterations per level, 0 for the trained ones')
+    parser.add_argument('--flow_scale', default=1, type=float, help='resolution scale of the flow estimation, <1 is faster and steadier on large motions, 0 picks it from the input size')
+    parser.add_argument('--precision', default='fp32', type=str, help='fp32|bf16|fp16, inference precision of convolutions and linear layers')
+    parser.add_argument('--crop_size', default=192, type=int)
+
+    ## server setting
+    parser.add_argument('--host', default='127.0.0.1', type=str)
+    parser.add_argument('--port', default=8000, type=int)
+    parser.add_argument('--batch_size', default=8, type=int, help='maximum number of pairs per forward pass')
+    parser.add_argument('--max_wait', default=10, type=float, help='ms a batch waits for more pairs of the same size')
+    parser.add_argument('--flow_cache', default='', type=str, help='folder of cached flows, repeated pairs skip the flow estimation')
+
+    parser.add_argument('--resume', default='./pretrained_models/pretrained_VFIformer/net_220.pth', type=str)
+    parser.add_argument('--resume_flownet', default='', type=str)
+
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s [%(levelname)s] %(message)s')
+
+    ## setup device
+    args.gpu_ids = [int(str_id) for str_id in args.gpu_ids.split(',') if int(str_id) >= 0]
+    if len(args.gpu_ids) > 0:
+        torch.cuda.set_device(args.gpu_ids[0])
+    args.dist = False
+    device = torch.device('cuda' if len(args.gpu_ids) != 0 else 'cpu')
+    args.device = device
+    print_args(args)
+
+    ## load model once
+    start = time.time()
+    net = define_G(args)
+    net = load_networks(net, args.resume)
+    net.eval()
+    if args.flow_cache:
+        net = CachedFlowModel(net, FlowCache(args.flow_cache, net))
+    logging.info('model loaded in %.2fs' % (time.time() - start))
+
+    ## serve
+    queue = BatchQueue(net, device, batch_size=args.batch_size, max_wait=args.max_wait / 1000.)
+    server = ThreadingHTTPServer((args.host, args.port), make_handler(queue))
+    logging.info('serving on http://%s:%d' % (args.host, args.port))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        server.server_close()
+
+
+if __name__ == '__main__':
+    main()
@@ -3,6 +3,7 @@ import time
 import logging
 import math
 import argparse
+import itertools
 import numpy as np
 import torch
 import torch.nn as nn
@@ -10,6 +11,7 @@ import torch.backends.cudnn as cudnn
 import torch.utils.data as data
 from utils.util import setup_logger, print_args
 from models.trainer import Trainer
+from models.quantize import quantize_G
 
 
 def main():
@@ -26,6 +28,13 @@ def main():
 
     ## network setting
     parser.add_argument('--net_name', default='VFIformer', type=str, help='')
+    parser.add_argument('--attn_backend', default='math', type=str, help='math|sdpa, sdpa uses F.scaled_dot_product_attention')
+    parser.add_argument('--refine_levels', default=4, type=int, help='VFIformer only: flow pyramid levels refined, 0-4, fewer is faster')
+    parser.add_argument('--refine_iters', default=0, type=int, help='VFIformer only: refinement iterations per level, 0 for the trained ones')
+    parser.add_argument('--flow_scale', default=1, type=float, help='resolution scale of the flow estimation, <1 is faster and steadier on large motions, 0 picks it from the input size')
+    parser.add_argument('--precision', default='fp32', type=str, help='fp32|bf16|fp16, inference precision of convolutions and linear layers')
+    parser.add_argument('--quantize', default='none', type=str, help='none|dynamic|static, int8 linear layers (dynamic) and conv blocks (static), CPU only')
+    parser.add_argument('--calib_samples', default=4, type=int, help='test samples calibrating the static quantization')
 
     ## dataloader setting
     parser.add_argument('--data_root', default='/home/sharedir/videos/vimeo_triplet/',type=str)
@@ -40,10 +49,15 @@ def main():
     parser.add_argument('--resume_flownet', default='', type=str)
     parser.add_argument('--save_folder', default='./test_results/', type=str)
     parser.add_argument('--save_result', action='store_true')
+    parser.add_argument('--flow_cache', default='', type=str, help='folder of cached flows, re-runs on the same test set skip the flow estimation')
+    parser.add_argument('--dataset_flow', action='store_true', help='VimeoDataset only: synthesize from the flows of compute_flow_vimeo.py the dataset loads')
 
 
     ## setup training environment
     args = parser.parse_args()
+    if args.quantize != 'none':
+        # the int8 kernels only run on CPU
+        args.gpu_ids = '-1'
 
     ## setup training device
     str_ids = args.gpu_ids.split(',')
@@ -77,6 +91,10 @@ def main():
 
     ## test model
     trainer = Trainer(args)
+    if args.quantize != 'none':
+        calib_pairs = [(samples['img0'], samples['img1']) for samples in
+                       map(trainer.prepare, itertools.islice(trainer.test_dataloader, args.calib_samples))]
+        trainer.net = quantize_G(trainer.net, args.quantize, calib_pairs)
     trainer.test()
 
 
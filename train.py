@@ -45,18 +45,21 @@ def main():
 
     ## network setting
     parser.add_argument('--net_name', default='VFIformer', type=str, help='RIFE')
+    parser.add_argument('--attn_backend', default='math', type=str, help='math|sdpa, sdpa uses F.scaled_dot_product_attention')
     parser.add_argument('--window_size', default=8, type=int)
+    parser.add_argument('--precision', default='fp32', type=str, help='fp32|bf16|fp16, mixed precision training, fp16 with gradient scaling')
 
     ## dataloader setting
     parser.add_argument('--data_root', default='/home/sharedir/videos/vimeo_triplet/',type=str)
-    parser.add_argument('--trainset', default='VimeoDataset', type=str, help='VimeoDataset')
+    parser.add_argument('--trainset', default='VimeoDataset', type=str, help='VimeoDataset|VimeoPackedDataset, the latter reads the shards of pack_vimeo.py')
     parser.add_argument('--testset', default='VimeoDataset', type=str, help='VimeoDataset')
     parser.add_argument('--save_test_root', default='generated', type=str)
     parser.add_argument('--crop_size', default=192, type=int)
     parser.add_argument('--batch_size', default=9, type=int)
     parser.add_argument('--num_workers', default=4, type=int)
+    parser.add_argument('--prefetch_factor', default=2, type=int, help='batches loaded ahead by every dataloader worker')
     parser.add_argument('--multi_scale', action='store_true')
-    parser.add_argument('--data_augmentation', action='store_true')
+    parser.add_argument('--data_augmentation', action='store_true', help='also rotate the crops by 90 degrees and reverse their color channels at random')
 
     ## optim setting
     parser.add_argument('--lr', default=1e-4, type=float)
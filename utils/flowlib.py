@@ -307,8 +307,8 @@ def read_flo_file(filename):
     if 202021.25 != magic:
         print('Magic number incorrect. Invalid .flo file')
     else:
-        w = np.fromfile(f, np.int32, count=1)
-        h = np.fromfile(f, np.int32, count=1)
+        w = np.fromfile(f, np.int32, count=1)[0]
+        h = np.fromfile(f, np.int32, count=1)[0]
         # print "Reading %d x %d flow file in .flo format" % (h, w)
         data2d = np.fromfile(f, np.float32, count=2 * int(w) * int(h))
         # reshape data into 3D array (columns, rows, channels)
@@ -0,0 +1,75 @@
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+
+def ordered_map(fn, items, num_workers=4, max_pending=8):
+    """Apply fn to items on a thread pool and yield the results in input order.
+
+    At most max_pending items are in flight: the pool stops taking new items while the
+    consumer lags behind, so decoded frames never pile up in memory. With num_workers 0
+    fn runs inline in the consumer.
+    """
+    if num_workers <= 0:
+        for item in items:
+            yield fn(item)
+        return
+
+    with ThreadPoolExecutor(num_workers) as pool:
+        pending = deque()
+        for item in items:
+            pending.append(pool.submit(fn, item))
+            if len(pending) >= max_pending:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+
+
+class AsyncWriter(object):
+    """Runs output jobs (encoding, writing) on a thread pool.
+
+    submit blocks while more than max_pending jobs are unfinished, so a slow encoder or
+    disk throttles the producer instead of queuing frames in memory. Jobs may finish in
+    any order, their results are passed to sink in submission order, e.g. to append
+    encoded frames to a stream. Errors of a job are raised by a later submit or by close.
+
+    Args:
+        num_workers (int): threads of the pool, 0 runs the jobs inline. Default: 4
+        max_pending (int): unfinished jobs before submit blocks. Default: 8
+        sink (callable | None): called with the result of every job, in order. Default: None
+    """
+
+    def __init__(self, num_workers=4, max_pending=8, sink=None):
+        self.pool = ThreadPoolExecutor(num_workers) if num_workers > 0 else None
+        self.max_pending = max_pending
+        self.sink = sink
+        self.pending = deque()
+
+    def finish(self, result):
+        if self.sink is not None:
+            self.sink(result)
+
+    def submit(self, fn, *args):
+        if self.pool is None:
+            self.finish(fn(*args))
+            return
+        self.pending.append(self.pool.submit(fn, *args))
+        while len(self.pending) > self.max_pending:
+            self.finish(self.pending.popleft().result())
+
+    def close(self):
+        while self.pending:
+            self.finish(self.pending.popleft().result())
+        if self.pool is not None:
+            self.pool.shutdown()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        elif self.pool is not None:
+            # cancel_futures of shutdown needs python 3.9
+            for future in self.pending:
+                future.cancel()
+            self.pool.shutdown(wait=True)
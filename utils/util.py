@@ -3,6 +3,7 @@ import sys
 import time
 from datetime import datetime
 import logging
+from collections import OrderedDict
 import numpy as np
 import torch
 import math
@@ -59,6 +60,64 @@ def scandir(dir_path, suffix=None, recursive=False, full_path=False):
     return _scandir(dir_path, suffix=suffix, recursive=recursive)
 
 
+class LRUCache(OrderedDict):
+    """Dict that keeps at most `maxsize` items, dropping the least recently used one.
+    Args:
+        maxsize (int): Maximum number of items. Default: 128.
+        max_bytes (int | None): Maximum total size of the tensors held by the items, an
+            item larger than that on its own is returned but not kept. Default: None.
+    """
+
+    def __init__(self, maxsize=128, max_bytes=None):
+        super(LRUCache, self).__init__()
+        self.maxsize = maxsize
+        self.max_bytes = max_bytes
+        self.nbytes = 0
+
+    def get(self, key, default=None):
+        if key not in self:
+            return default
+        self.move_to_end(key)
+        return self[key]
+
+    def put(self, key, value):
+        nbytes = tensor_nbytes(value)
+        if self.max_bytes is not None and nbytes > self.max_bytes:
+            return value
+        if key in self:
+            self.nbytes -= tensor_nbytes(self.pop(key))
+        self[key] = value
+        self.nbytes += nbytes
+        while len(self) > self.maxsize or (self.max_bytes is not None and self.nbytes > self.max_bytes):
+            self.nbytes -= tensor_nbytes(self.popitem(last=False)[1])
+        return value
+
+    def clear(self):
+        super(LRUCache, self).clear()
+        self.nbytes = 0
+
+
+def tensor_nbytes(value):
+    # size of the tensors in a (nested) tuple / list
+    if isinstance(value, torch.Tensor):
+        return value.numel() * value.element_size()
+    if isinstance(value, (tuple, list)):
+        return sum(tensor_nbytes(v) for v in value)
+    return 0
+
+
+def is_compiling():
+    """True while torch.compile / torch.export trace the caller, always False on torch
+    releases without torch.compiler.is_compiling (before 2.3)."""
+    compiler = getattr(torch, 'compiler', None)
+    if compiler is not None and hasattr(compiler, 'is_compiling'):
+        return compiler.is_compiling()
+    dynamo = getattr(torch, '_dynamo', None)
+    if dynamo is not None and hasattr(dynamo, 'is_compiling'):
+        return dynamo.is_compiling()
+    return False
+
+
 def setup_logger(log_file_path):
     log_formatter = logging.Formatter("%(asctime)s [%(levelname)-5.5s]  %(message)s")
     root_logger = logging.getLogger()
@@ -1,178 +1,282 @@
-import sys
-import getopt
-import math
-import numpy
-# import torch
-# import torch.utils.serialization
-# import PIL
-# import PIL.Image
-
-import random
-import logging
 import numpy as np
-from scipy.misc import imresize
-import matplotlib as mpl
-# mpl.use('Agg')
-import matplotlib.pyplot as plt
-# plt.style.use('bmh')
-from skimage.color import rgb2yuv, yuv2rgb
+import torch
+import torch.nn.functional as F
 
-import os
-from shutil import copyfile
-from skimage.measure import compare_ssim, compare_psnr
 
+FRAME_FORMATS = ('yuv420', 'nv12', 'rgb24', 'bgr24')
+# (kr, kb) luma weights of the YCbCr matrices
+YUV_MATRICES = {'bt601': (0.299, 0.114), 'bt709': (0.2126, 0.0722)}
 
-# from PYTHON_Flow2Color.flowToColor import flowToColor
-# from PYTHON_Flow2Color.writeFlowFile import writeFlowFile
-# from AverageMeter import  *
 
-class YUV_Read():
-    def __init__(self, filepath, h, w, format='yuv420', toRGB=True):
+def get_frame_length(h, w, format='yuv420'):
+    assert format in FRAME_FORMATS, 'unknown frame format: %s' % format
+    if format in ('yuv420', 'nv12'):
+        assert h % 2 == 0 and w % 2 == 0, '%s frames need an even size, got %dx%d' % (format, w, h)
+        return h * w * 3 // 2
+    return h * w * 3
+
+
+def yuv_to_bgr(y, u, v, matrix='bt601', full_range=False):
+    """Convert YCbCr 4:2:0 planes to a BGR image, on the device of the planes.
+
+    Args:
+        y (Tensor): (H, W) uint8 luma.
+        u, v (Tensor): (H/2, W/2) uint8 chroma, upsampled as nearest neighbours.
+        matrix (str): 'bt601' | 'bt709'. Default: 'bt601'
+        full_range (bool): 0-255 levels instead of the 16-235 (luma) and 16-240
+            (chroma) levels of video. Default: False
+
+    Returns:
+        Tensor: (3, H, W) float BGR in [0, 1].
+    """
+    kr, kb = YUV_MATRICES[matrix]
+    h, w = y.shape
+    if full_range:
+        y = y.float() / 255.
+        u = (u.float() - 128.) / 255.
+        v = (v.float() - 128.) / 255.
+    else:
+        y = (y.float() - 16.) / 219.
+        u = (u.float() - 128.) / 224.
+        v = (v.float() - 128.) / 224.
+    # every chroma sample covers a 2x2 block of luma, broadcast instead of upsampled copies
+    y = y.view(h // 2, 2, w // 2, 2)
+    u = u[:, None, :, None]
+    v = v[:, None, :, None]
+    r = y + 2 * (1 - kr) * v
+    b = y + 2 * (1 - kb) * u
+    g = (y - kr * r - kb * b) / (1 - kr - kb)
+    return torch.stack((b, g, r), 0).view(3, h, w).clamp_(0., 1.)
+
+
+def bgr_to_yuv(img, matrix='bt601', full_range=False):
+    """Convert a batch of BGR images to YCbCr 4:2:0 planes, on the device of the images.
+
+    Args:
+        img (Tensor): (B, 3, H, W) float BGR in [0, 1], H and W even.
+        matrix (str): 'bt601' | 'bt709'. Default: 'bt601'
+        full_range (bool): 0-255 levels instead of the levels of video. Default: False
+
+    Returns:
+        (y, u, v): (B, H, W) and twice (B, H/2, W/2) uint8 tensors, the chroma of every
+            2x2 block is the average of its pixels.
+    """
+    kr, kb = YUV_MATRICES[matrix]
+    b, g, r = img.float().clamp(0., 1.).unbind(1)
+    y = kr * r + (1 - kr - kb) * g + kb * b
+    # the matrix is linear, so the chroma of the block averages is the average chroma
+    y_avg, b_avg, r_avg = F.avg_pool2d(torch.stack((y, b, r), 1), 2).unbind(1)
+    u = (b_avg - y_avg) / (2 * (1 - kb))
+    v = (r_avg - y_avg) / (2 * (1 - kr))
+    if full_range:
+        y, u, v = y * 255., u * 255. + 128., v * 255. + 128.
+    else:
+        y, u, v = y * 219. + 16., u * 224. + 128., v * 224. + 128.
+    return tuple(x.round_().clamp_(0., 255.).byte() for x in (y, u, v))
+
+
+class YUVReader(object):
+    """Random access reader of raw yuv420 (I420), nv12, rgb24 or bgr24 streams.
 
+    The file is memory mapped, planes() returns views into the mapping without reading
+    or copying anything, the pages of a frame are only loaded when it is converted.
+
+    Args:
+        filepath (str): raw stream, frames back to back without headers.
+        h, w (int): frame size.
+        format (str): 'yuv420' | 'nv12' | 'rgb24' | 'bgr24'. Default: 'yuv420'
+        matrix (str): YCbCr matrix, 'bt601' | 'bt709'. Default: 'bt601'
+        full_range (bool): full range YCbCr levels. Default: False
+    """
+
+    def __init__(self, filepath, h, w, format='yuv420', matrix='bt601', full_range=False):
         self.h = h
         self.w = w
+        self.format = format
+        self.matrix = matrix
+        self.full_range = full_range
+        self.frame_length = get_frame_length(h, w, format)
+        # copy-on-write, the views are writable for torch.from_numpy but never change the file
+        self.data = np.memmap(filepath, dtype=np.uint8, mode='c')
+        self.num_frames = self.data.size // self.frame_length
 
-        self.fp = open(filepath, 'rb')
+    def __len__(self):
+        return self.num_frames
 
-        if format == 'yuv420':
-            self.frame_length = int(1.5 * h * w)
-            self.Y_length = h * w
-            self.Uv_length = int(0.25 * h * w)
-        else:
-            pass
+    def raw(self, idx):
+        """Zero-copy view of the bytes of frame idx."""
+        if idx < 0:
+            idx += self.num_frames
+        if not 0 <= idx < self.num_frames:
+            raise IndexError('frame %d out of range, the stream has %d frames' % (idx, self.num_frames))
+        return self.data[idx * self.frame_length:(idx + 1) * self.frame_length]
+
+    def planes(self, idx):
+        """Zero-copy views of frame idx: (Y, U, V) for yuv420, (Y, UV) for nv12, (H, W, 3) else."""
+        h, w = self.h, self.w
+        frame = self.raw(idx)
+        if self.format == 'yuv420':
+            return (frame[:h * w].reshape(h, w),
+                    frame[h * w:h * w * 5 // 4].reshape(h // 2, w // 2),
+                    frame[h * w * 5 // 4:].reshape(h // 2, w // 2))
+        if self.format == 'nv12':
+            return frame[:h * w].reshape(h, w), frame[h * w:].reshape(h // 2, w // 2, 2)
+        return (frame.reshape(h, w, 3),)
+
+    def get_tensor(self, idx, device='cpu'):
+        """Frame idx as a (3, H, W) float BGR tensor in [0, 1], converted on `device`."""
+        planes = [torch.from_numpy(plane).to(device, non_blocking=True) for plane in self.planes(idx)]
+        if self.format == 'yuv420':
+            return yuv_to_bgr(planes[0], planes[1], planes[2], self.matrix, self.full_range)
+        if self.format == 'nv12':
+            return yuv_to_bgr(planes[0], planes[1][..., 0], planes[1][..., 1], self.matrix, self.full_range)
+        img = planes[0].permute(2, 0, 1).float() / 255.
+        return img.flip(0) if self.format == 'rgb24' else img
+
+    def __getitem__(self, idx):
+        """Frame idx as an (H, W, 3) BGR uint8 image, like cv2.imread returns it."""
+        img = self.get_tensor(idx)
+        return img.mul_(255.).round_().byte().permute(1, 2, 0).numpy()
+
+    def __iter__(self):
+        for idx in range(self.num_frames):
+            yield self[idx]
+
+
+class YUV_Read():
+    # sequential interface of the old reader, frames come as RGB uint8 (toRGB) or as
+    # full resolution YUV uint8 stacked along the last axis
+    def __init__(self, filepath, h, w, format='yuv420', toRGB=True):
+        self.reader = YUVReader(filepath, h, w, format)
         self.toRGB = toRGB
+        self.idx = 0
 
     def read(self, offset_frame=None):
-        if not offset_frame == None:
-            self.fp.seek(offset_frame * self.frame_length, 0)
-
-        Y = np.fromfile(self.fp, np.uint8, count=self.Y_length)
-        U = np.fromfile(self.fp, np.uint8, count=self.Uv_length)
-        V = np.fromfile(self.fp, np.uint8, count=self.Uv_length)
-        if Y.size < self.Y_length or \
-                        U.size < self.Uv_length or \
-                        V.size < self.Uv_length:
+        if offset_frame is not None:
+            self.idx = offset_frame
+        if self.idx >= len(self.reader):
             return None, False
-
-        Y = np.reshape(Y, [self.w, self.h], order='F')
-        Y = np.transpose(Y)
-
-        U = np.reshape(U, [int(self.w / 2), int(self.h / 2)], order='F')
-        U = np.transpose(U)
-
-        V = np.reshape(V, [int(self.w / 2), int(self.h / 2)], order='F')
-        V = np.transpose(V)
-
-        U = imresize(U, [self.h, self.w], interp='nearest')
-        V = imresize(V, [self.h, self.w], interp='nearest')
-
-        # plt.figure(3)
-        # plt.title("GT")
-        # plt.imshow(np.stack((Y,Y,Y),axis=-1))
-        # plt.show()
-        #
-        # plt.figure(3)
-        # plt.title("GT")
-        # plt.imshow(np.stack((U,U,U),axis=-1))
-        # plt.show()
-        # plt.figure(3)
-        # plt.title("GT")
-        # plt.imshow(np.stack((V,V,V),axis=-1))
-        # plt.show()
         if self.toRGB:
-            Y = Y / 255.0
-            U = U / 255.0 - 0.5
-            V = V / 255.0 - 0.5
-            self.YUV = np.stack((Y, U, V), axis=-1)
-            self.RGB = (255.0 * np.clip(yuv2rgb(self.YUV), 0.0, 1.0)).astype('uint8')
-
-            # plt.figure(3)
-            # plt.title("GT")
-            # plt.imshow(self.RGB)
-            # plt.show()
-            self.YUV = None
-            return self.RGB, True
+            frame = self.reader[self.idx][:, :, ::-1]
         else:
-            self.YUV = np.stack((Y, U, V), axis=-1)
-            return self.YUV, True
+            Y, U, V = self.reader.planes(self.idx)
+            U = U.repeat(2, 0).repeat(2, 1)
+            V = V.repeat(2, 0).repeat(2, 1)
+            frame = np.stack((Y, U, V), axis=-1)
+        self.idx += 1
+        return frame, True
+
+    def close(self):
+        self.reader = None
+
+
+class YUVWriter(object):
+    """Writer of raw yuv420 (I420), nv12, rgb24 or bgr24 streams, e.g. for an encoder pipe.
+
+    Frames are converted batch-wise on the device they come from and copied into a
+    preallocated buffer of batch_size frames, which is written with a single call
+    whenever it is full and on close.
+
+    Args:
+        filepath (str): output stream, overwritten.
+        h, w (int): frame size.
+        format (str): 'yuv420' | 'nv12' | 'rgb24' | 'bgr24'. Default: 'yuv420'
+        matrix (str): YCbCr matrix, 'bt601' | 'bt709'. Default: 'bt601'
+        full_range (bool): full range YCbCr levels. Default: False
+        batch_size (int): frames buffered per write. Default: 8
+        pin_memory (bool): page-locked buffer, for faster copies from the GPU. Default: False
+    """
+
+    def __init__(self, filepath, h, w, format='yuv420', matrix='bt601', full_range=False, batch_size=8,
+                 pin_memory=False):
+        self.h = h
+        self.w = w
+        self.format = format
+        self.matrix = matrix
+        self.full_range = full_range
+        self.frame_length = get_frame_length(h, w, format)
+        self.buffer = torch.empty((batch_size, self.frame_length), dtype=torch.uint8, pin_memory=pin_memory)
+        self.num_buffered = 0
+        self.num_frames = 0
+        # buffered, writes larger than its buffer go straight to the file and partial
+        # writes to pipes are retried by the io layer
+        self.fp = open(filepath, 'wb')
+
+    def pack(self, frames):
+        # (B, 3, H, W) float BGR -> (B, frame_length) uint8 in the layout of the format
+        if self.format in ('rgb24', 'bgr24'):
+            if self.format == 'rgb24':
+                frames = frames.flip(1)
+            frames = frames.float().clamp(0., 1.).mul(255.).round_().byte()
+            return frames.permute(0, 2, 3, 1).reshape(frames.size(0), -1)
+        y, u, v = bgr_to_yuv(frames, self.matrix, self.full_range)
+        chroma = (u, v) if self.format == 'yuv420' else (torch.stack((u, v), -1),)
+        return torch.cat([x.reshape(x.size(0), -1) for x in (y,) + chroma], 1)
+
+    def append(self, packed):
+        # copy packed frames into the buffer, flushing it whenever it fills up
+        start = 0
+        while start < packed.size(0):
+            n = min(packed.size(0) - start, self.buffer.size(0) - self.num_buffered)
+            self.buffer[self.num_buffered:self.num_buffered + n].copy_(packed[start:start + n])
+            self.num_buffered += n
+            start += n
+            if self.num_buffered == self.buffer.size(0):
+                self.flush()
+
+    def pack_raw(self, frame):
+        # a frame that is already in the output format -> (1, frame_length) uint8
+        frame = torch.from_numpy(np.ascontiguousarray(frame).reshape(1, -1))
+        assert frame.size(1) == self.frame_length, 'expected %d bytes per frame, got %d' % (self.frame_length, frame.size(1))
+        return frame
+
+    def write(self, frames):
+        """Append (B, 3, H, W) or (3, H, W) float BGR frames in [0, 1], on any device."""
+        if frames.dim() == 3:
+            frames = frames.unsqueeze(0)
+        assert frames.shape[1:] == (3, self.h, self.w), 'expected %dx%d frames, got %s' % (self.w, self.h, tuple(frames.shape))
+        self.write_packed(self.pack(frames))
+
+    def write_raw(self, frame):
+        """Append a frame that is already in the output format, e.g. from YUVReader.raw."""
+        self.write_packed(self.pack_raw(frame))
+
+    def write_packed(self, packed):
+        """Append (B, frame_length) frames of pack / pack_raw, e.g. converted on writer threads."""
+        self.append(packed)
+        self.num_frames += packed.size(0)
+
+    def flush(self):
+        if self.num_buffered:
+            self.fp.write(self.buffer[:self.num_buffered].numpy().data)
+            self.num_buffered = 0
 
     def close(self):
+        self.flush()
         self.fp.close()
 
 
 class YUV_Write():
+    # per frame interface of the old writer, frames come as RGB uint8 (fromRGB) or as
+    # full resolution YUV uint8 stacked along the last axis
     def __init__(self, filepath, fromRGB=True):
-
-        # self.h = h
-        # self.w = w
-        if os.path.exists(filepath):
-            print(filepath)
-            # raise("YUV File Exist Error")
-  
-        self.fp = open(filepath, 'wb')  # no appending
+        self.filepath = filepath
         self.fromRGB = fromRGB
+        self.writer = None
 
     def write(self, Frame):
-
-        self.h = Frame.shape[0]
-        self.w = Frame.shape[1]
-        c = Frame.shape[2]
-
+        h, w, c = Frame.shape
         assert c == 3
-        if format == 'yuv420':
-            self.frame_length = int(1.5 * self.h * self.w)
-            self.Y_length = self.h * self.w
-            self.Uv_length = int(0.25 * self.h * self.w)
-        else:
-            pass
+        if self.writer is None:
+            self.writer = YUVWriter(self.filepath, h, w, batch_size=1)
         if self.fromRGB:
-            Frame = Frame / 255.0
-            YUV = rgb2yuv(Frame)
-            Y, U, V = np.dsplit(YUV, 3)
-            Y = Y[:, :, 0]
-            U = U[:, :, 0]
-            V = V[:, :, 0]
-            # print(Y.shape)
-
-            # Y = np.transpose(Y,())
-            U = np.clip(U + 0.5, 0.0, 1.0)
-            V = np.clip(V + 0.5, 0.0, 1.0)
-
-            U = U[::2, ::2]  # imresize(U,[int(self.h/2),int(self.w/2)],interp = 'nearest')
-            V = V[::2, ::2]  # imresize(V ,[int(self.h/2),int(self.w/2)],interp = 'nearest')
-            Y = (255.0 * Y).astype('uint8')
-            U = (255.0 * U).astype('uint8')
-            V = (255.0 * V).astype('uint8')
+            frame = torch.from_numpy(np.ascontiguousarray(Frame[:, :, ::-1])).permute(2, 0, 1).float() / 255.
+            self.writer.write(frame)
         else:
-            YUV = Frame
-            Y = YUV[:, :, 0]
-            U = YUV[::2, ::2, 1]
-            V = YUV[::2, ::2, 2]
-
-        # plt.figure(3)
-        # plt.title("GT")
-        # plt.imshow(np.stack((Y,Y,Y),axis=-1))
-        # plt.show()
-        #
-        # plt.figure(3)
-        # plt.title("GT")
-        # plt.imshow(np.stack((U,U,U),axis=-1))
-        # plt.show()
-        # plt.figure(3)
-        # plt.title("GT")
-        # plt.imshow(np.stack((V,V,V),axis=-1))
-        # plt.show()
-        # print(Y.shape)
-        # print(U.shape)
-        Y = Y.flatten()  # the first order is 0-dimension so don't need to transpose before flatten
-        U = U.flatten()
-        V = V.flatten()
-
-        Y.tofile(self.fp)
-        U.tofile(self.fp)
-        V.tofile(self.fp)
-
+            self.writer.write_raw(np.concatenate([Frame[:, :, 0].ravel(), Frame[::2, ::2, 1].ravel(),
+                                                  Frame[::2, ::2, 2].ravel()]))
         return True
 
     def close(self):
-        self.fp.close()
\ No newline at end of file
+        if self.writer is not None:
+            self.writer.close()